@@ -1,6 +1,53 @@
-from flask import Flask, render_template_string, request, send_file
-from PIL import Image, ImageDraw, ImageFont
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from flask import (
+    Flask,
+    Response,
+    g,
+    request,
+    send_file,
+    stream_with_context,
+)
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+try:
+    import fcntl
+except ImportError:  # Windows: storage sweeps run without the cross-process lock
+    fcntl = None
+from PIL import Image, ImageDraw, ImageFont, features
+import base64
+import contextlib
+import contextvars
+import csv
+import functools
+import hashlib
+import html
+import io
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import queue
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
 
 app = Flask(__name__)
 
@@ -8,83 +55,92 @@ app = Flask(__name__)
 # HTML TEMPLATE (Boliden-style)
 # =========================
 
+# Shared by both pages and served from a content-hashed URL, so browsers
+# keep it for a year and fetch it again only when it changes.
+STYLESHEET = """body {
+    font-family: Arial, sans-serif;
+    margin: 40px;
+    background: #f4f7fa;
+    color: #1f2933;
+}
+h1 {
+    margin-bottom: 4px;
+    color: #3C577C;
+}
+small {
+    color: #6b7b8c;
+}
+textarea { width: 360px; height: 140px; }
+input[type=text] { width: 360px; }
+select { width: 180px; }
+.section {
+    margin-bottom: 25px;
+    padding: 15px 18px;
+    background: #ffffff;
+    border-radius: 10px;
+    border: 1px solid #d0d7e2;
+    box-shadow: 0 2px 4px rgba(0,0,0,0.03);
+}
+.section h3 {
+    margin-top: 0;
+    color: #3C577C;
+}
+.row {
+    display: flex;
+    gap: 20px;
+    flex-wrap: wrap;
+}
+.col {
+    flex: 1 1 320px;
+}
+.submit-row {
+    margin-top: 15px;
+}
+input[type=submit] {
+    padding: 10px 18px;
+    border-radius: 6px;
+    border: none;
+    background: #3C577C;
+    color: white;
+    font-weight: bold;
+    cursor: pointer;
+}
+input[type=submit]:hover {
+    background: #304462;
+}
+.avatar-preview {
+    max-width: 380px;
+    border-radius: 8px;
+    border: 1px solid #d0d7e2;
+    margin-bottom: 10px;
+    background: white;
+}
+.results {
+    display: flex;
+    flex-direction: column;
+}
+a {
+    color: #3C577C;
+    text-decoration: none;
+}
+a:hover {
+    text-decoration: underline;
+}
+hr {
+    border: none;
+    border-top: 1px solid #d0d7e2;
+    margin: 10px 0 20px;
+}
+"""
+STYLESHEET_NAME = f"avatar-{hashlib.sha256(STYLESHEET.encode('utf-8')).hexdigest()[:12]}.css"
+STYLESHEET_URL = f"/assets/{STYLESHEET_NAME}"
+
 html_template = """
 <!DOCTYPE html>
 <html>
 <head>
     <title>Boliden Mentorship Avatar Generator</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            margin: 40px;
-            background: #f4f7fa;
-            color: #1f2933;
-        }
-        h1 {
-            margin-bottom: 4px;
-            color: #3C577C;
-        }
-        small {
-            color: #6b7b8c;
-        }
-        textarea { width: 360px; height: 140px; }
-        input[type=text] { width: 360px; }
-        select { width: 180px; }
-        .section {
-            margin-bottom: 25px;
-            padding: 15px 18px;
-            background: #ffffff;
-            border-radius: 10px;
-            border: 1px solid #d0d7e2;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.03);
-        }
-        .section h3 {
-            margin-top: 0;
-            color: #3C577C;
-        }
-        .row {
-            display: flex;
-            gap: 20px;
-            flex-wrap: wrap;
-        }
-        .col {
-            flex: 1 1 320px;
-        }
-        .submit-row {
-            margin-top: 15px;
-        }
-        input[type=submit] {
-            padding: 10px 18px;
-            border-radius: 6px;
-            border: none;
-            background: #3C577C;
-            color: white;
-            font-weight: bold;
-            cursor: pointer;
-        }
-        input[type=submit]:hover {
-            background: #304462;
-        }
-        .avatar-preview {
-            max-width: 380px;
-            border-radius: 8px;
-            border: 1px solid #d0d7e2;
-            margin-bottom: 10px;
-            background: white;
-        }
-        a {
-            color: #3C577C;
-            text-decoration: none;
-        }
-        a:hover {
-            text-decoration: underline;
-        }
-        hr {
-            border: none;
-            border-top: 1px solid #d0d7e2;
-            margin: 10px 0 20px;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ stylesheet_url }}">
 </head>
 <body>
     <h1>Boliden Mentorship Avatar Generator</h1>
@@ -154,6 +210,11 @@ html_template = """
         </div>
 
         <div class="submit-row">
+            <label>Format:</label>
+            <select name="format">
+                <option value="png">PNG</option>
+                <option value="svg">SVG (vector)</option>
+            </select>
             <input type="submit" value="Generate Avatars">
         </div>
     </form>
@@ -161,21 +222,272 @@ html_template = """
 </html>
 """
 
+# Streamed by /generate: the page around the results goes out at once, then
+# one block per avatar as soon as it has rendered. Blocks arrive in
+# completion order; their flex order keeps A above B on the page.
+result_template = """<!DOCTYPE html>
+<html>
+<head>
+    <title>Generated Avatars – Boliden Mentorship</title>
+    <link rel="stylesheet" href="{{ stylesheet_url }}">
+</head>
+<body>
+    <h1>Generated Avatars</h1>
+    <div class="results">
+    <!-- results -->
+    </div>
+    <p><a href="/">Create more avatars</a></p>
+</body>
+</html>
+"""
+
+result_block_template = """
+        <div class="section" style="order: {{ order }}"
+            {%- if server_timing %} data-server-timing="{{ server_timing }}"{% endif %}
+            {%- if layers %} data-avatar-layers="{{ layers }}"{% endif %}>
+            <h2>{{ title }}</h2>
+            {%- if error %}
+            <p>{{ error }}</p>
+            {%- else %}
+            <img class="avatar-preview" src="{{ preview_src }}" alt="{{ title }}">
+            <br>
+            <a href="{{ url }}">Download {{ format | upper }}</a>
+            {%- endif %}
+        </div>"""
+
+# Compiled once at import, with autoescaping (render_template_string
+# compiles on every call). Pages without per-request input are rendered
+# once here as well.
+INDEX_PAGE = app.jinja_env.from_string(html_template).render(
+    stylesheet_url=STYLESHEET_URL
+).encode("utf-8")
+INDEX_ETAG = hashlib.sha256(INDEX_PAGE).hexdigest()
+RESULT_PAGE_HEAD, RESULT_PAGE_TAIL = app.jinja_env.from_string(result_template).render(
+    stylesheet_url=STYLESHEET_URL
+).split("<!-- results -->")
+result_block = app.jinja_env.from_string(result_block_template)
+
+# =========================
+# METRICS
+# =========================
+
+# Per-process metrics in Prometheus text format on /metrics. Under gunicorn
+# each worker keeps its own numbers; scrape them per worker.
+SERVER_TIMING = os.environ.get("AVATAR_SERVER_TIMING") == "1"
+SECONDS_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+
+class Metrics:
+    """Counters, gauges and histograms keyed by name and label values."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # name -> (kind, help)
+        self._values = {}      # name -> {labels: value or [bucket counts, sum, count]}
+        self._collectors = []  # callables run before each scrape
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+
+    def collector(self, fn):
+        """Register fn(metrics), called at scrape time to refresh gauges."""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[name][key] = value
+
+    def clear(self, name: str):
+        """Drop every series of a metric, e.g. an info gauge whose labels changed."""
+        with self._lock:
+            self._values[name].clear()
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._values[name].get(key)
+            if state is None:
+                state = self._values[name][key] = [[0] * len(SECONDS_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(SECONDS_BUCKETS):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> str:
+        for fn in self._collectors:
+            fn(self)
+        out = []
+        with self._lock:
+            for name, (kind, help_text) in self._meta.items():
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self._values[name].items()):
+                    if kind == "histogram":
+                        buckets, total, count = value
+                        for bound, n in zip(SECONDS_BUCKETS, buckets):
+                            out.append(f"{name}_bucket{_labels(key + (('le', repr(bound)),))} {n}")
+                        out.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {count}")
+                        out.append(f"{name}_sum{_labels(key)} {total}")
+                        out.append(f"{name}_count{_labels(key)} {count}")
+                    else:
+                        out.append(f"{name}{_labels(key)} {value}")
+        return "\n".join(out) + "\n"
+
+
+def _labels(key) -> str:
+    if not key:
+        return ""
+    parts = []
+    for label, value in key:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{label}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+metrics = Metrics()
+metrics.describe("avatar_stage_seconds", "histogram", "Time spent in each render stage.")
+metrics.describe("avatar_request_seconds", "histogram", "Request latency by endpoint.")
+metrics.describe("avatar_requests_total", "counter", "Requests by endpoint and status.")
+metrics.describe("avatar_renders_in_flight", "gauge", "Renders currently running.")
+metrics.describe("avatar_bytes_written_total", "counter", "Bytes written to disk by target.")
+metrics.describe("avatar_cache_lookups_total", "counter", "Cache lookups by cache and result.")
+metrics.describe("avatar_cache_evictions_total", "counter", "Entries evicted from each cache.")
+metrics.describe("avatar_cache_entries", "gauge", "Entries currently held by each cache.")
+metrics.describe("avatar_cache_hit_ratio", "gauge", "Share of lookups answered by each cache.")
+metrics.describe("avatar_storage_bytes", "gauge", "Bytes of persisted output at the last sweep.")
+metrics.describe("avatar_storage_files", "gauge", "Persisted output files at the last sweep.")
+metrics.describe("avatar_storage_removed_total", "counter", "Persisted files removed by reason.")
+metrics.describe("avatar_lexicon_info", "gauge", "Version of the trait lexicon in use.")
+metrics.describe("avatar_render_service_requests_total", "counter",
+                 "Renders sent to the render service by result.")
+metrics.describe("avatar_render_dedup_total", "counter",
+                 "Cache misses answered by a render already in progress, by scope.")
+metrics.describe("avatar_render_rejections_total", "counter",
+                 "Renders refused because this process was at its render capacity.")
+metrics.describe("avatar_render_load", "gauge", "Render cost in progress and waiting, by state.")
+metrics.describe("avatar_input_rejections_total", "counter",
+                 "Inputs refused before rendering for exceeding a limit, by reason.")
+
+
+# Stage timings and layer outcomes of the render running in this thread,
+# while one is being reported on (see render_report()).
+_render_report = contextvars.ContextVar("render_report", default=None)
+
+
+@contextlib.contextmanager
+def render_report():
+    """
+    Collect the stage timings and layer outcomes of the renders in the block.
+    Renders run on pool threads after the response has started, so they are
+    reported per result block rather than in response headers.
+    """
+    report = {"stages": [], "layers": []}
+    token = _render_report.set(report)
+    try:
+        yield report
+    finally:
+        _render_report.reset(token)
+
+
+def format_server_timing(stages) -> str:
+    """Server-Timing syntax, e.g. "analyze;dur=0.05, text;dur=3.10"."""
+    # Stages such as "text" run more than once per render; sum them.
+    totals = {}
+    for stage, seconds in stages:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1e3:.2f}" for stage, seconds in totals.items())
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """Record how long the block took, and add it to the render report if enabled."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("avatar_stage_seconds", elapsed, stage=stage)
+        report = _render_report.get()
+        if SERVER_TIMING and report is not None:
+            report["stages"].append((stage, elapsed))
+
+
 # =========================
 # FONT & FILENAME HELPERS
 # =========================
 
+FONT_CANDIDATES = [
+    "arial.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+FONT_PRELOAD_SIZES = (20, 24, 38)
+
+_font_path = None      # resolved once; "" means no TrueType font was found
+_fonts = {}            # size -> loaded font
+_font_lock = threading.Lock()
+
+
+def resolve_font_path() -> str:
+    """Pick the first loadable font in FONT_CANDIDATES (only tried once)."""
+    global _font_path
+    if _font_path is None:
+        with _font_lock:
+            if _font_path is None:
+                resolved = ""
+                for candidate in FONT_CANDIDATES:
+                    try:
+                        ImageFont.truetype(candidate, FONT_PRELOAD_SIZES[0])
+                    except OSError:
+                        continue
+                    resolved = candidate
+                    break
+                _font_path = resolved
+    return _font_path
+
+
 def get_font(size: int) -> ImageFont.ImageFont:
-    """Try to load a TrueType font, otherwise fall back to the default."""
-    try:
-        return ImageFont.truetype("arial.ttf", size)
-    except OSError:
-        try:
-            return ImageFont.truetype(
-                "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", size
-            )
-        except OSError:
-            return ImageFont.load_default()
+    """Return the shared font for this size, loading it on first use."""
+    font = _fonts.get(size)
+    if font is None:
+        path = resolve_font_path()
+        with _font_lock:
+            font = _fonts.get(size)
+            if font is None:
+                with timed("font_load"):
+                    if path:
+                        font = ImageFont.truetype(path, size)
+                    else:
+                        font = ImageFont.load_default()
+                _fonts[size] = font
+    return font
+
+
+def preload_fonts(sizes=FONT_PRELOAD_SIZES):
+    for size in sizes:
+        get_font(size)
+
+
+def font_info() -> dict:
+    """Which font was picked and which sizes are loaded, for operators."""
+    path = resolve_font_path()
+    return {
+        "path": path or None,
+        "fallback": not path,
+        "candidates": list(FONT_CANDIDATES),
+        "loaded_sizes": sorted(_fonts),
+    }
 
 
 def safe_filename(title: str) -> str:
@@ -188,72 +500,219 @@ def safe_filename(title: str) -> str:
     return cleaned.replace(" ", "_") + ".png"
 
 
+# Rendered files are named "<title slug>-<render key>.<ext>". The name is a
+# pure function of the content, so concurrent workers never hand out each
+# other's images and rewriting an existing name writes identical bytes.
+OUTPUT_NAME_RE = re.compile(
+    r"^(?P<slug>[A-Za-z0-9_-]+)-(?P<key>[0-9a-f]{32})\.(?P<ext>png|svg)$"
+)
+
+
+def output_name(title: str, key: str, ext: str = "png") -> str:
+    return safe_filename(title)[:-len(".png")] + f"-{key}.{ext}"
+
+
+def parse_output_name(filename: str):
+    """Return (download name, render key, extension) for an output_name(), or None."""
+    match = OUTPUT_NAME_RE.match(filename)
+    if match is None:
+        return None
+    ext = match.group("ext")
+    return f"{match.group('slug')}.{ext}", match.group("key"), ext
+
+
+# The process umask, read once at import (os.umask can only be read by
+# setting it). mkstemp creates files 0600; written files get the mode open()
+# would have given them instead.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def atomic_write(path: str, data: bytes):
+    """Write via a temp file in the same folder and rename, so readers never see a torn file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        metrics.inc("avatar_bytes_written_total", len(data),
+                    target=os.path.basename(os.path.dirname(os.path.abspath(path))))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
 # =========================
 # BEHAVIOUR ANALYSIS
 # =========================
 
+# The keyword lexicon is data, not code: {"version": N, "categories":
+# {category: [keyword, ...]}}. Editing the file changes the traits of new
+# renders without a restart (see Lexicon).
+LEXICON_PATH = os.environ.get(
+    "AVATAR_LEXICON_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "trait_lexicon.json"),
+)
+LEXICON_CHECK_SECONDS = 2.0   # how often a worker stats the file for changes
+TRAIT_CATEGORIES = (
+    "positive", "negative", "high_energy", "low_energy", "low_reliability", "warmth", "cold",
+)
+
+
+class TraitMatcher:
+    """
+    Keyword lexicon compiled once, scoring a text with the same substring
+    semantics as `sum(w in text for w in words)` per category.
+
+    Each distinct keyword is scanned for once with a C-level `in`, however
+    many categories it counts towards; tokenizing the text in Python or a
+    regex over it is slower on vocabulary it has not seen before (see
+    `python bench.py traits`).
+    """
+
+    def __init__(self, lexicon: dict, version=None):
+        self.lexicon = lexicon
+        self.categories = list(lexicon)
+        # keyword -> categories it counts towards; "kall" is negative and cold
+        self.keyword_categories = {}
+        for category, words in lexicon.items():
+            for word in words:
+                self.keyword_categories.setdefault(word, []).append(category)
+
+        # Changes whenever the lexicon does, even if the file's version number
+        # was not bumped; part of every cached analysis and render key.
+        digest = hashlib.sha256(
+            json.dumps(lexicon, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        self.version = digest[:12] if version is None else f"{version}-{digest[:8]}"
+
+    def scores(self, text: str) -> dict:
+        found = [w for w in self.keyword_categories if w in text]
+        scores = dict.fromkeys(self.categories, 0)
+        for word in found:
+            for category in self.keyword_categories[word]:
+                scores[category] += 1
+        return scores
+
+
+def load_lexicon(path: str) -> TraitMatcher:
+    """Read and compile a lexicon file; ValueError if it is malformed."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    categories = data.get("categories") if isinstance(data, dict) else None
+    if not isinstance(categories, dict):
+        raise ValueError("expected an object with a 'categories' object")
+    missing = [c for c in TRAIT_CATEGORIES if c not in categories]
+    if missing:
+        raise ValueError(f"missing categories: {', '.join(missing)}")
+    for category, words in categories.items():
+        if not isinstance(words, list) or not all(isinstance(w, str) and w for w in words):
+            raise ValueError(f"category {category!r} must be a list of keywords")
+    lexicon = {c: [w.lower() for w in words] for c, words in categories.items()}
+    return TraitMatcher(lexicon, data.get("version"))
+
+
+class Lexicon:
+    """
+    The TraitMatcher compiled from a lexicon file, recompiled when the file
+    changes.
+
+    current() only stats the file once per check_seconds and compares its
+    mtime and size, so the hot path is a clock read. A changed file is
+    compiled off to the side and swapped in with a single assignment; a file
+    that fails to load is logged and the previous matcher stays in use.
+    """
+
+    def __init__(self, path: str, check_seconds: float):
+        self.path = path
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._stamp = self._stat()
+        self.matcher = load_lexicon(path)
+        self._checked = time.monotonic()
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def current(self) -> TraitMatcher:
+        if time.monotonic() - self._checked < self.check_seconds:
+            return self.matcher
+        with self._lock:
+            if time.monotonic() - self._checked < self.check_seconds:
+                return self.matcher
+            self._checked = time.monotonic()
+            try:
+                stamp = self._stat()
+            except OSError as exc:
+                app.logger.warning("Cannot stat lexicon %s: %s", self.path, exc)
+                return self.matcher
+            if stamp != self._stamp:
+                self._stamp = stamp
+                try:
+                    matcher = load_lexicon(self.path)
+                except (OSError, ValueError) as exc:
+                    app.logger.warning("Keeping lexicon %s, reload failed: %s",
+                                       self.matcher.version, exc)
+                else:
+                    self.matcher = matcher
+                    app.logger.info("Loaded trait lexicon %s", matcher.version)
+        return self.matcher
+
+
+lexicon = Lexicon(LEXICON_PATH, LEXICON_CHECK_SECONDS)
+
+
+def derive_openness(mood: str, warmth: str) -> str:
+    if mood == "good" or warmth == "warm":
+        return "open"
+    elif mood == "bad" or warmth == "cold":
+        return "closed"
+    else:
+        return "medium"
+
+
+BULLETS = frozenset("-*•")
+
+
+def normalize_behaviours(behaviours) -> tuple:
+    """
+    Behaviour lines as the trait analysis reads them: lowercased, whitespace
+    collapsed, a leading "- " / "* " / "• " bullet removed and empty lines dropped.
+    """
+    lines = []
+    for line in "\n".join(behaviours).lower().split("\n"):
+        words = line.split()
+        if words and words[0] in BULLETS:
+            del words[0]
+        if words:
+            lines.append(" ".join(words))
+    return tuple(lines)
+
+
 def analyze_behaviours(behaviours, role: str, profile: str):
-    """Analyse behaviour text and derive visual traits."""
-    text = ("\n".join(behaviours)).lower()
-
-    positive_words = [
-        "listen", "listens", "listening", "lyssnar",
-        "empathy", "empathetic", "empatisk",
-        "open", "öppen", "curious", "nyfiken",
-        "support", "supportive", "stöd",
-        "encourag", "uppmuntr",
-        "present", "närvarande",
-        "respect", "respekt",
-        "honest", "transparent", "ärlig",
-        "prepared", "förberedd", "forberedd", "reflect", "reflekter"
-    ]
-
-    negative_words = [
-        "interrupt", "avbryter",
-        "ego", "self-centered", "pratar om sig själv",
-        "judge", "judging", "kritiserar", "klandrar",
-        "blame", "shame",
-        "cold", "kall",
-        "arrogant", "hård", "kontrollerande",
-        "sarcastic", "sarkastisk",
-        "not listening", "doesn't listen", "doesnt listen", "lyssnar inte"
-    ]
-
-    high_energy_words = [
-        "energetic", "engaged", "engagerad",
-        "motivating", "inspiring", "inspirerar",
-        "driven", "driv", "active"
-    ]
-
-    low_energy_words = [
-        "tired", "trött", "passive", "passiv",
-        "drained", "exhausted", "utmattad",
-        "low energy", "nedstämd", "flat"
-    ]
-
-    low_reliability_words = [
-        "late", "sen", "always late",
-        "cancel", "ställer in", "no show",
-        "doesn't show", "doesnt show",
-        "comes unprepared", "unprepared", "ingen återkoppling"
-    ]
-
-    warmth_words = [
-        "warm", "caring", "kind", "snäll",
-        "safe", "trygg", "welcoming"
-    ]
-    cold_words = [
-        "distant", "remote", "kall", "stiff", "stel",
-        "detached"
-    ]
-
-    score_pos = sum(w in text for w in positive_words)
-    score_neg = sum(w in text for w in negative_words)
-    score_hi_e = sum(w in text for w in high_energy_words)
-    score_lo_e = sum(w in text for w in low_energy_words)
-    score_low_rel = sum(w in text for w in low_reliability_words)
-    score_warm = sum(w in text for w in warmth_words)
-    score_cold = sum(w in text for w in cold_words)
+    """Analyse behaviour text and derive visual traits, memoized in trait_cache."""
+    lines = normalize_behaviours(behaviours)
+    return dict(trait_cache.get_or_compute(lines, role, profile))
+
+
+def compute_traits(lines: tuple, role: str, profile: str, matcher: TraitMatcher = None):
+    """Traits for normalize_behaviours() output; analyze_behaviours() without the cache."""
+    text = "\n".join(lines)
+
+    scores = (matcher or lexicon.current()).scores(text)
+    score_pos = scores["positive"]
+    score_neg = scores["negative"]
+    score_hi_e = scores["high_energy"]
+    score_lo_e = scores["low_energy"]
+    score_low_rel = scores["low_reliability"]
+    score_warm = scores["warmth"]
+    score_cold = scores["cold"]
 
     # Mood baseline
     if profile == "ultimate":
@@ -289,13 +748,7 @@ def analyze_behaviours(behaviours, role: str, profile: str):
     else:
         warmth = "neutral"
 
-    # Openness
-    if mood == "good" or warmth == "warm":
-        openness = "open"
-    elif mood == "bad" or warmth == "cold":
-        openness = "closed"
-    else:
-        openness = "medium"
+    openness = derive_openness(mood, warmth)
 
     return {
         "role": role,
@@ -312,22 +765,9 @@ def analyze_behaviours(behaviours, role: str, profile: str):
 # AVATAR DRAWING
 # =========================
 
-def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
-    """
-    Draw a more human-like cartoon person with face expression and body language
-    based on the traits dict from analyze_behaviours().
-    """
-    left, top, right, bottom = box
-    width = right - left
-    height = bottom - top
-    cx = (left + right) // 2
-
-    mood = traits["mood"]          # good / bad / neutral
-    energy = traits["energy"]      # high / medium / low
-    reliability = traits["reliability"]
-    warmth = traits["warmth"]
-    openness = traits["openness"]
-    role = traits["role"]
+def figure_colours(traits) -> dict:
+    """Panel, clothing and skin colours for the traits."""
+    mood = traits["mood"]
 
     # --- Colours (panel + clothes) ----------------------------------------
     if traits["profile"] == "ultimate" or mood == "good":
@@ -340,26 +780,65 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
         panel_color = (228, 236, 246)   # soft blue
         shirt_color = (117, 167, 212)   # lighter blue
 
-    if role == "trainee":
+    if traits["role"] == "trainee":
         # trainees lite ljusare topp
         shirt_color = tuple(min(255, c + 20) for c in shirt_color)
 
     pants_color = (44, 62, 80)
-    if reliability == "low":
+    if traits["reliability"] == "low":
         pants_color = (127, 140, 141)
 
     skin_color = (244, 222, 200)
     hair_color = (70, 50, 40)
-    if warmth == "cold":
+    if traits["warmth"] == "cold":
         skin_color = (232, 220, 210)
 
+    return {
+        "panel": panel_color,
+        "shirt": shirt_color,
+        "pants": pants_color,
+        "skin": skin_color,
+        "hair": hair_color,
+    }
+
+
+def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits, scale: float = 1.0):
+    """
+    Draw a more human-like cartoon person with face expression and body language
+    based on the traits dict from analyze_behaviours().
+
+    Proportions follow the box; fixed pixel sizes (strokes, eyes, limbs) are
+    multiplied by scale, so a box scaled along with them gives the same figure.
+    """
+    def px(value):
+        return round(value * scale)
+
+    def stroke(value):
+        return max(1, px(value))
+
+    left, top, right, bottom = box
+    width = right - left
+    height = bottom - top
+    cx = (left + right) // 2
+
+    mood = traits["mood"]          # good / bad / neutral
+    energy = traits["energy"]      # high / medium / low
+    openness = traits["openness"]
+
+    colours = figure_colours(traits)
+    panel_color = colours["panel"]
+    shirt_color = colours["shirt"]
+    pants_color = colours["pants"]
+    skin_color = colours["skin"]
+    hair_color = colours["hair"]
+
     # --- Panel background --------------------------------------------------
-    margin = 8
+    margin = px(8)
     draw.rectangle(
         (left + margin, top + margin, right - margin, bottom - margin),
         fill=panel_color,
         outline=(208, 214, 225),
-        width=2,
+        width=stroke(2),
     )
 
     # --- Head position: lägre vid låg energi/dåligt läge ------------------
@@ -378,7 +857,7 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
         cx + head_radius,
         head_cy + head_radius,
     )
-    draw.ellipse(head_box, fill=skin_color, outline=(90, 90, 90), width=2)
+    draw.ellipse(head_box, fill=skin_color, outline=(90, 90, 90), width=stroke(2))
 
     # --- Hair: bara på övre delen av huvudet -------------------------------
     hair_height = int(head_radius * 1.0)
@@ -393,7 +872,7 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
     # --- Eyes --------------------------------------------------------------
     eye_y = head_cy - int(head_radius * 0.12)
     eye_offset_x = int(head_radius * 0.45)
-    eye_r = 4
+    eye_r = stroke(4)
 
     if mood == "bad" or energy == "low":
         # halvstängda / trötta ögon – bara linjer
@@ -402,7 +881,7 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
                 (cx + dx - eye_r, eye_y,
                  cx + dx + eye_r, eye_y),
                 fill=(40, 40, 40),
-                width=2
+                width=stroke(2)
             )
     else:
         # öppna ögon
@@ -414,49 +893,51 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
             )
 
     # --- Brows -------------------------------------------------------------
-    brow_y = eye_y - 10
-    brow_len = 24
+    brow_y = eye_y - px(10)
+    brow_len = px(24)
+    brow_out = px(6)
 
     if mood == "good":
         # lite uppåt/vänlig
-        left_brow = (cx - eye_offset_x - 6, brow_y + 2,
-                     cx - eye_offset_x + brow_len, brow_y - 1)
-        right_brow = (cx + eye_offset_x - brow_len, brow_y - 1,
-                      cx + eye_offset_x + 6, brow_y + 2)
+        left_brow = (cx - eye_offset_x - brow_out, brow_y + px(2),
+                     cx - eye_offset_x + brow_len, brow_y - px(1))
+        right_brow = (cx + eye_offset_x - brow_len, brow_y - px(1),
+                      cx + eye_offset_x + brow_out, brow_y + px(2))
     elif mood == "bad":
         # arg / bekymrad – nedåtvänd
-        left_brow = (cx - eye_offset_x - 6, brow_y - 1,
-                     cx - eye_offset_x + brow_len, brow_y + 4)
-        right_brow = (cx + eye_offset_x - brow_len, brow_y + 4,
-                      cx + eye_offset_x + 6, brow_y - 1)
+        left_brow = (cx - eye_offset_x - brow_out, brow_y - px(1),
+                     cx - eye_offset_x + brow_len, brow_y + px(4))
+        right_brow = (cx + eye_offset_x - brow_len, brow_y + px(4),
+                      cx + eye_offset_x + brow_out, brow_y - px(1))
     else:
         # neutrala
-        left_brow = (cx - eye_offset_x - 6, brow_y,
+        left_brow = (cx - eye_offset_x - brow_out, brow_y,
                      cx - eye_offset_x + brow_len, brow_y)
         right_brow = (cx + eye_offset_x - brow_len, brow_y,
-                      cx + eye_offset_x + 6, brow_y)
+                      cx + eye_offset_x + brow_out, brow_y)
 
-    draw.line(left_brow, fill=(50, 40, 40), width=2)
-    draw.line(right_brow, fill=(50, 40, 40), width=2)
+    draw.line(left_brow, fill=(50, 40, 40), width=stroke(2))
+    draw.line(right_brow, fill=(50, 40, 40), width=stroke(2))
 
     # --- Mouth -------------------------------------------------------------
     mouth_y = head_cy + int(head_radius * 0.45)
     mouth_w = int(head_radius * 0.9)
+    mouth_stroke = stroke(3)
 
     if mood == "good":
         draw.arc(
-            (cx - mouth_w, mouth_y - 18, cx + mouth_w, mouth_y + 8),
-            start=200, end=340, fill=(90, 50, 50), width=3
+            (cx - mouth_w, mouth_y - px(18), cx + mouth_w, mouth_y + px(8)),
+            start=200, end=340, fill=(90, 50, 50), width=mouth_stroke
         )
     elif mood == "bad":
         draw.arc(
-            (cx - mouth_w, mouth_y - 4, cx + mouth_w, mouth_y + 24),
-            start=20, end=160, fill=(90, 50, 50), width=3
+            (cx - mouth_w, mouth_y - px(4), cx + mouth_w, mouth_y + px(24)),
+            start=20, end=160, fill=(90, 50, 50), width=mouth_stroke
         )
     else:
         draw.line(
             (cx - mouth_w // 2, mouth_y, cx + mouth_w // 2, mouth_y),
-            fill=(90, 50, 50), width=3
+            fill=(90, 50, 50), width=mouth_stroke
         )
 
     # --- Neck --------------------------------------------------------------
@@ -475,9 +956,9 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
     body_w = int(width * 0.32)
 
     if energy == "high" and mood == "good":
-        tilt = -4   # lite framåtlutad, engagerad
+        tilt = -px(4)   # lite framåtlutad, engagerad
     elif energy == "low" or mood == "bad":
-        tilt = 4    # lite “hängig”
+        tilt = px(4)    # lite “hängig”
     else:
         tilt = 0
 
@@ -488,72 +969,73 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
         (body_left, body_top, body_right, body_top + body_h),
         fill=shirt_color,
         outline=(80, 80, 80),
-        width=2,
+        width=stroke(2),
     )
 
     # --- Arms --------------------------------------------------------------
-    shoulder_y = body_top + 18
+    shoulder_y = body_top + px(18)
     arm_len = int(height * 0.23)
-    arm_width = 10
+    arm_width = stroke(10)
+    inset = px(5)
 
     if openness == "open" and mood == "good":
         if energy == "high":
             # armar upp/ut – mycket positiv
             draw.line(
-                (body_left + 5, shoulder_y,
-                 body_left - 25, shoulder_y - arm_len + 15),
+                (body_left + inset, shoulder_y,
+                 body_left - px(25), shoulder_y - arm_len + px(15)),
                 fill=shirt_color, width=arm_width
             )
             draw.line(
-                (body_right - 5, shoulder_y,
-                 body_right + 25, shoulder_y - arm_len + 15),
+                (body_right - inset, shoulder_y,
+                 body_right + px(25), shoulder_y - arm_len + px(15)),
                 fill=shirt_color, width=arm_width
             )
         else:
             # öppna armar snett nedåt
             draw.line(
-                (body_left + 5, shoulder_y,
-                 body_left - 30, shoulder_y + arm_len),
+                (body_left + inset, shoulder_y,
+                 body_left - px(30), shoulder_y + arm_len),
                 fill=shirt_color, width=arm_width
             )
             draw.line(
-                (body_right - 5, shoulder_y,
-                 body_right + 30, shoulder_y + arm_len),
+                (body_right - inset, shoulder_y,
+                 body_right + px(30), shoulder_y + arm_len),
                 fill=shirt_color, width=arm_width
             )
     elif openness == "closed" or mood == "bad":
         # korsade armar
-        cross_y = shoulder_y + 18
+        cross_y = shoulder_y + px(18)
         draw.line(
-            (body_left + 5, cross_y + 12,
-             cx + 10, cross_y - 10),
+            (body_left + inset, cross_y + px(12),
+             cx + px(10), cross_y - px(10)),
             fill=shirt_color, width=arm_width
         )
         draw.line(
-            (cx - 10, cross_y - 10,
-             body_right - 5, cross_y + 12),
+            (cx - px(10), cross_y - px(10),
+             body_right - inset, cross_y + px(12)),
             fill=shirt_color, width=arm_width
         )
     else:
         # neutralt – armar rakt ned
         draw.line(
-            (body_left + 5, shoulder_y,
-             body_left + 5, shoulder_y + arm_len),
+            (body_left + inset, shoulder_y,
+             body_left + inset, shoulder_y + arm_len),
             fill=shirt_color, width=arm_width
         )
         draw.line(
-            (body_right - 5, shoulder_y,
-             body_right - 5, shoulder_y + arm_len),
+            (body_right - inset, shoulder_y,
+             body_right - inset, shoulder_y + arm_len),
             fill=shirt_color, width=arm_width
         )
 
     # --- Legs & shoes ------------------------------------------------------
     leg_top = body_top + body_h
     leg_len = int(height * 0.26)
-    leg_gap = 18
-    leg_w = 16
+    leg_gap = px(18)
+    leg_w = px(16)
 
-    leg_tilt = 3 if energy == "low" and mood == "bad" else 0
+    leg_tilt = px(3) if energy == "low" and mood == "bad" else 0
 
     # vänster ben
     draw.rectangle(
@@ -568,196 +1050,2637 @@ def draw_avatar_person(draw: ImageDraw.ImageDraw, box, traits):
         fill=pants_color,
     )
 
-    shoe_h = 14
+    shoe_h = px(14)
     draw.rectangle(
-        (cx - leg_gap - 24 + leg_tilt, leg_top + leg_len,
-         cx - leg_gap + 28 + leg_tilt, leg_top + leg_len + shoe_h),
+        (cx - leg_gap - px(24) + leg_tilt, leg_top + leg_len,
+         cx - leg_gap + px(28) + leg_tilt, leg_top + leg_len + shoe_h),
         fill=(30, 30, 30),
     )
     draw.rectangle(
-        (cx + leg_gap - 28 + leg_tilt, leg_top + leg_len,
-         cx + leg_gap + 24 + leg_tilt, leg_top + leg_len + shoe_h),
+        (cx + leg_gap - px(28) + leg_tilt, leg_top + leg_len,
+         cx + leg_gap + px(24) + leg_tilt, leg_top + leg_len + shoe_h),
         fill=(30, 30, 30),
     )
 
 
 # =========================
-# CREATE IMAGE
+# TEXT LAYOUT
+# =========================
+
+# Behaviour text is shrunk through these sizes before it gets truncated.
+BEHAVIOUR_FONT_SIZES = (24, 20)
+WORD_WIDTH_CACHE_SIZE = 20000    # words per font size
+LAYOUT_CACHE_SIZE = 1024
+
+_word_widths = {}    # font size -> {word: advance width}
+_word_widths_lock = threading.Lock()
+
+
+def line_spacing_for(font_size: int) -> int:
+    return round(font_size * 4 / 3)
+
+
+def word_width(word: str, font_size: int) -> float:
+    """Advance width of a word in the shared font, cached per size."""
+    widths = _word_widths.get(font_size)
+    if widths is None:
+        with _word_widths_lock:
+            widths = _word_widths.setdefault(font_size, {})
+    width = widths.get(word)
+    if width is None:
+        width = get_font(font_size).getlength(word)
+        if len(widths) >= WORD_WIDTH_CACHE_SIZE:
+            widths.clear()
+        widths[word] = width
+    return width
+
+
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def wrap_lines(lines: tuple, font_size: int, max_width: int) -> tuple:
+    """
+    Greedy word wrap of each behaviour line to max_width.
+
+    Each word is measured once (from the width cache) and line widths are
+    summed as words are added, so wrapping is linear in the text length.
+    A word wider than max_width gets a line of its own.
+    """
+    space = word_width(" ", font_size)
+    wrapped = []
+    for text in lines:
+        line_words = []
+        line_width = 0.0
+        for word in text.split():
+            width = word_width(word, font_size)
+            new_width = line_width + space + width if line_words else width
+            if new_width > max_width and line_words:
+                wrapped.append(" ".join(line_words))
+                line_words = [word]
+                line_width = width
+            else:
+                line_words.append(word)
+                line_width = new_width
+        if line_words:
+            wrapped.append(" ".join(line_words))
+    return tuple(wrapped)
+
+
+def fit_behaviours(behaviours, max_width: int, max_height: int,
+                   font_sizes=BEHAVIOUR_FONT_SIZES) -> dict:
+    """
+    Lay out behaviour lines to fit max_width x max_height.
+
+    Tries each of font_sizes in turn; if the text is still too tall at the
+    smallest size, the lines that don't fit are dropped and counted in
+    hidden_lines (one line is kept free to say so).
+    """
+    lines = tuple(b.strip() for b in behaviours if b.strip())
+    for font_size in font_sizes:
+        spacing = line_spacing_for(font_size)
+        wrapped = wrap_lines(lines, font_size, max_width)
+        if len(wrapped) * spacing <= max_height:
+            return {"lines": wrapped, "font_size": font_size,
+                    "line_spacing": spacing, "hidden_lines": 0}
+
+    fits = max(max_height // spacing - 1, 0)
+    return {"lines": wrapped[:fits], "font_size": font_size,
+            "line_spacing": spacing, "hidden_lines": len(wrapped) - fits}
+
+
+# =========================
+# FIGURE SPRITES
+# =========================
+
+BACKGROUND_COLOR = (245, 247, 250)
+# Shoes reach a little below the avatar box, so sprites extend past it.
+FIGURE_SPRITE_BLEED = 40
+# Limited by pixel memory like LayerCache: a full-size sprite is ~1 MB, and
+# reusing one saves only the ~0.3 ms of drawing the figure.
+FIGURE_SPRITE_CACHE_BYTES = int(os.environ.get("AVATAR_SPRITE_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+
+def figure_key(traits) -> tuple:
+    """Everything draw_avatar_person() depends on, as a hashable key."""
+    colours = figure_colours(traits)
+    return (
+        tuple(sorted(colours.items())),
+        traits["mood"],
+        traits["energy"],
+        traits["openness"],
+    )
+
+
+_figure_sprites = OrderedDict()   # (size, scale, figure_key) -> sprite
+_figure_sprites_bytes = 0
+_figure_sprites_lock = threading.Lock()
+
+
+def figure_sprite(size, traits, scale: float = 1.0) -> Image.Image:
+    """
+    The figure for these traits drawn on the background colour, memoized.
+
+    The cache is keyed by figure_key(), so traits that only differ in ways
+    the drawing ignores (e.g. profile once the mood is good) share a sprite.
+    """
+    cache_key = (tuple(size), scale, figure_key(traits))
+    with _figure_sprites_lock:
+        sprite = _figure_sprites.get(cache_key)
+        if sprite is not None:
+            _figure_sprites.move_to_end(cache_key)
+    metrics.inc("avatar_cache_lookups_total", cache="sprite",
+                result="miss" if sprite is None else "hit")
+    note_layer("figure", reused=sprite is not None)
+    if sprite is not None:
+        return sprite
+
+    width, height = size
+    # Kept as RGB: pasting a palette image converts it on every paste, which
+    # costs more than drawing the figure from scratch.
+    bleed = round(FIGURE_SPRITE_BLEED * scale)
+    sprite = Image.new("RGB", (width, height + bleed), BACKGROUND_COLOR)
+    draw_avatar_person(ImageDraw.Draw(sprite), (0, 0, width, height), traits, scale)
+
+    global _figure_sprites_bytes
+    with _figure_sprites_lock:
+        old = _figure_sprites.pop(cache_key, None)
+        if old is not None:
+            _figure_sprites_bytes -= old.width * old.height * 3
+        _figure_sprites[cache_key] = sprite
+        _figure_sprites_bytes += sprite.width * sprite.height * 3
+        while _figure_sprites_bytes > FIGURE_SPRITE_CACHE_BYTES and len(_figure_sprites) > 1:
+            _, evicted = _figure_sprites.popitem(last=False)
+            _figure_sprites_bytes -= evicted.width * evicted.height * 3
+    return sprite
+
+
+def reachable_traits():
+    """Every traits dict analyze_behaviours() can return."""
+    for role, profile, mood, energy, reliability, warmth in itertools.product(
+        ("mentor", "trainee"),
+        ("ultimate", "worst", "mixed"),
+        ("good", "bad", "neutral"),
+        ("high", "medium", "low"),
+        ("high", "low"),
+        ("warm", "cold", "neutral"),
+    ):
+        yield {
+            "role": role,
+            "profile": profile,
+            "mood": mood,
+            "energy": energy,
+            "reliability": reliability,
+            "warmth": warmth,
+            "openness": derive_openness(mood, warmth),
+        }
+
+
+def warm_figure_sprites(size=None) -> int:
+    """
+    Render the sprite for reachable trait combinations until the sprite cache
+    is full (all ~200 need AVATAR_SPRITE_CACHE_BYTES of ~180 MB); returns the
+    count rendered.
+    """
+    size = size or AVATAR_BOX_SIZE
+    keys = set()
+    for traits in reachable_traits():
+        key = figure_key(traits)
+        if key in keys:
+            continue
+        figure_sprite(size, traits)
+        keys.add(key)
+        sprite_bytes = _figure_sprites_bytes / len(_figure_sprites)
+        if _figure_sprites_bytes + sprite_bytes > FIGURE_SPRITE_CACHE_BYTES:
+            break
+    return len(keys)
+
+
+# =========================
+# LAYERS
 # =========================
 
-def create_avatar_image(title: str, behaviours, role: str, profile: str, filename: str):
-    """Create a full avatar image with figure on the left and behaviours on the right."""
-    img_w, img_h = 1100, 800
-    img = Image.new("RGB", (img_w, img_h), (245, 247, 250))
-    draw = ImageDraw.Draw(img)
+# A raster render is three layers that never overlap on the background:
+# the header (title and subtitle), the figure sprite and the behaviour
+# text. Each layer is cached by the inputs it is drawn from, so editing one
+# behaviour line redraws the text block and reuses the header and figure.
+LAYER_CACHE_MAX_BYTES = 48 * 1024 * 1024
+
+
+class LayerCache:
+    """Bounded LRU of (layer, inputs) -> RGB image, limited by pixel memory."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None:
+                self._items.move_to_end(key)
+            return img
+
+    def put(self, key, img: Image.Image):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old.width * old.height * 3
+            self._items[key] = img
+            self.size += img.width * img.height * 3
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= evicted.width * evicted.height * 3
+
+
+layer_cache = LayerCache(LAYER_CACHE_MAX_BYTES)
+
+
+def note_layer(layer: str, reused: bool):
+    """Remember in the render report whether a layer was reused or drawn."""
+    report = _render_report.get()
+    if report is not None:
+        report["layers"].append((layer, "reused" if reused else "drawn"))
+
+
+def format_layers(layers) -> str:
+    """e.g. "header;reused=1;drawn=0, figure;reused=1;drawn=0, text;reused=0;drawn=1"."""
+    counts = {}
+    for layer, outcome in layers:
+        counts.setdefault(layer, {"reused": 0, "drawn": 0})[outcome] += 1
+    return ", ".join(
+        f"{layer};reused={c['reused']};drawn={c['drawn']}" for layer, c in counts.items()
+    )
+
+
+def cached_layer(layer: str, inputs: tuple, region, draw_layer) -> Image.Image:
+    """
+    The image of region drawn by draw_layer(draw, origin), from layer_cache
+    when the same inputs were drawn before.
+    """
+    key = (layer, inputs, tuple(region))
+    img = layer_cache.get(key)
+    metrics.inc("avatar_cache_lookups_total", cache=f"{layer}_layer",
+                result="miss" if img is None else "hit")
+    note_layer(layer, reused=img is not None)
+    if img is None:
+        left, top, right, bottom = region
+        img = Image.new("RGB", (right - left, bottom - top), BACKGROUND_COLOR)
+        draw_layer(ImageDraw.Draw(img), (left, top))
+        layer_cache.put(key, img)
+    return img
+
+
+# =========================
+# DRAWING BACKENDS
+# =========================
+
+def svg_colour(colour) -> str:
+    if colour is None:
+        return "none"
+    return "#%02x%02x%02x" % tuple(colour[:3])
+
+
+class SvgDraw:
+    """
+    The part of ImageDraw that the avatar drawing code uses, recording SVG
+    elements instead of pixels.
+
+    Coordinates follow Pillow: a box (x0, y0, x1, y1) includes its last
+    pixel, outlines are drawn inside the box and text is placed by the top
+    of its ascender.
+    """
+
+    def __init__(self, size, background):
+        self.size = size
+        self.elements = []
+        self.rectangle((0, 0, size[0] - 1, size[1] - 1), fill=background)
+
+    @staticmethod
+    def _paint(fill, outline, width) -> str:
+        attrs = f'fill="{svg_colour(fill)}"'
+        if outline is not None and width:
+            attrs += f' stroke="{svg_colour(outline)}" stroke-width="{width}"'
+        return attrs
+
+    def rectangle(self, xy, fill=None, outline=None, width=1):
+        x0, y0, x1, y1 = xy
+        inset = width / 2 if outline is not None else 0
+        self.elements.append(
+            f'<rect x="{x0 + inset:g}" y="{y0 + inset:g}" '
+            f'width="{x1 - x0 + 1 - 2 * inset:g}" height="{y1 - y0 + 1 - 2 * inset:g}" '
+            f'{self._paint(fill, outline, width)}/>'
+        )
+
+    def ellipse(self, xy, fill=None, outline=None, width=1):
+        x0, y0, x1, y1 = xy
+        inset = width / 2 if outline is not None else 0
+        self.elements.append(
+            f'<ellipse cx="{(x0 + x1 + 1) / 2:g}" cy="{(y0 + y1 + 1) / 2:g}" '
+            f'rx="{(x1 - x0 + 1) / 2 - inset:g}" ry="{(y1 - y0 + 1) / 2 - inset:g}" '
+            f'{self._paint(fill, outline, width)}/>'
+        )
+
+    def line(self, xy, fill=None, width=0):
+        x0, y0, x1, y1 = xy
+        self.elements.append(
+            f'<line x1="{x0 + 0.5:g}" y1="{y0 + 0.5:g}" x2="{x1 + 0.5:g}" y2="{y1 + 0.5:g}" '
+            f'stroke="{svg_colour(fill)}" stroke-width="{max(width, 1)}"/>'
+        )
+
+    def arc(self, xy, start, end, fill=None, width=1):
+        x0, y0, x1, y1 = xy
+        cx, cy = (x0 + x1 + 1) / 2, (y0 + y1 + 1) / 2
+        rx, ry = (x1 - x0 + 1 - width) / 2, (y1 - y0 + 1 - width) / 2
+
+        # Angles are clockwise from 3 o'clock, as in Pillow (y points down).
+        def point(angle):
+            rad = math.radians(angle)
+            return f"{cx + rx * math.cos(rad):.2f} {cy + ry * math.sin(rad):.2f}"
 
-    # Title
-    title_font = get_font(38)
-    draw.text((40, 30), title, font=title_font, fill=(34, 46, 80))
+        large_arc = 1 if (end - start) % 360 > 180 else 0
+        self.elements.append(
+            f'<path d="M {point(start)} A {rx:g} {ry:g} 0 {large_arc} 1 {point(end)}" '
+            f'fill="none" stroke="{svg_colour(fill)}" stroke-width="{width}"/>'
+        )
+
+    def text(self, xy, text, font=None, fill=None):
+        x, y = xy
+        size = getattr(font, "size", 10)
+        ascent = font.getmetrics()[0] if hasattr(font, "getmetrics") else size
+        family = font.getname()[0] if hasattr(font, "getname") else "sans-serif"
+        self.elements.append(
+            f'<text x="{x}" y="{y + ascent}" font-family="{html.escape(family)}, sans-serif" '
+            f'font-size="{size}" fill="{svg_colour(fill)}" xml:space="preserve">'
+            f'{html.escape(text, quote=False)}</text>'
+        )
+
+    def tobytes(self) -> bytes:
+        width, height = self.size
+        head = (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+                f'viewBox="0 0 {width} {height}">')
+        return "\n".join([head, *self.elements, "</svg>\n"]).encode("utf-8")
+
+
+class RasterBackend:
+    """Draws with Pillow into an RGB image, pasting the figure from figure_sprite()."""
+
+    def __init__(self, size):
+        self.image = Image.new("RGB", size, BACKGROUND_COLOR)
+        self.draw = ImageDraw.Draw(self.image)
+
+    def figure(self, box, traits, scale: float):
+        left, top, right, bottom = box
+        self.image.paste(figure_sprite((right - left, bottom - top), traits, scale), (left, top))
+
+    def layer(self, name: str, inputs: tuple, region, draw_layer):
+        img = cached_layer(name, inputs, region, draw_layer)
+        with timed("composite"):
+            self.image.paste(img, tuple(region[:2]))
+
+    def result(self) -> Image.Image:
+        return self.image
+
+
+class SvgBackend:
+    """Records the same drawing as SVG; vector output has nothing to cache per figure."""
+
+    def __init__(self, size):
+        self.draw = SvgDraw(size, BACKGROUND_COLOR)
+
+    def figure(self, box, traits, scale: float):
+        draw_avatar_person(self.draw, box, traits, scale)
+
+    def layer(self, name: str, inputs: tuple, region, draw_layer):
+        draw_layer(self.draw, (0, 0))
+
+    def result(self) -> SvgDraw:
+        return self.draw
 
-    # Subtitle
-    subtitle_font = get_font(20)
-    subtitle = f"{role.capitalize()} - {profile.capitalize()} profile"
-    draw.text((40, 70), subtitle, font=subtitle_font, fill=(90, 104, 128))
 
-    # Traits & avatar
-    traits = analyze_behaviours(behaviours, role, profile)
-    avatar_box = (40, 110, 460, img_h - 40)
-    draw_avatar_person(draw, avatar_box, traits)
+DRAW_BACKENDS = {
+    "raster": RasterBackend,
+    "svg": SvgBackend,
+}
 
-    # Behaviours on right side
-    text_left = 500
-    text_top = 130
-    max_width = img_w - text_left - 40
-    behaviour_font = get_font(24)
-    line_spacing = 32
-    y = text_top
+
+# =========================
+# CREATE IMAGE
+# =========================
+
+def _save_palette_png(img: Image.Image, buf):
+    # A render has a few hundred colours, almost all of them antialiased text
+    # edges, so 256 palette entries are visually lossless (max error ~13/255).
+    img.quantize(256, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE).save(
+        buf, format="PNG"
+    )
+
+
+# Measured with `python bench.py encode` on 1100x800 renders: palette PNG is
+# the smallest PNG (only WebP is smaller) at near-fastest encode time
+# (26.3 ms against 22.9 ms for png-fast), so it is the default.
+ENCODERS = {
+    "png": {
+        "mimetype": "image/png",
+        "save": lambda img, buf: img.save(buf, format="PNG"),
+    },
+    "png-fast": {
+        "mimetype": "image/png",
+        "save": lambda img, buf: img.save(buf, format="PNG", compress_level=1),
+    },
+    "png-optimized": {
+        "mimetype": "image/png",
+        "save": lambda img, buf: img.save(buf, format="PNG", optimize=True),
+    },
+    "png-palette": {
+        "mimetype": "image/png",
+        "save": _save_palette_png,
+    },
+    "webp": {
+        "mimetype": "image/webp",
+        "save": lambda img, buf: img.save(buf, format="WEBP", lossless=True),
+    },
+    "svg": {
+        "mimetype": "image/svg+xml",
+        "backend": "svg",
+        "save": lambda svg, buf: buf.write(svg.tobytes()),
+    },
+}
+
+IMAGE_ENCODER = os.environ.get("AVATAR_IMAGE_ENCODER", "png-palette")
+# Served instead of IMAGE_ENCODER to clients that accept WebP; "" disables it.
+WEBP_ENCODER = os.environ.get("AVATAR_WEBP_ENCODER", "webp")
+if WEBP_ENCODER and not features.check("webp"):
+    WEBP_ENCODER = ""
+
+
+def encode_image(img, encoder: str) -> bytes:
+    buf = io.BytesIO()
+    ENCODERS[encoder]["save"](img, buf)
+    return buf.getvalue()
+
+
+def accepts_webp(accept_mimetypes) -> bool:
+    # Only an explicit image/webp counts; "*/*" says nothing about support.
+    return any(value == "image/webp" and quality > 0 for value, quality in accept_mimetypes)
+
+
+def negotiate_encoder(accept_mimetypes) -> str:
+    if WEBP_ENCODER and accepts_webp(accept_mimetypes):
+        return WEBP_ENCODER
+    return IMAGE_ENCODER
+
+
+# Layout of a full-size image; draw_avatar_image() scales all of it.
+IMAGE_SIZE = (1100, 800)
+AVATAR_BOX = (40, 110, 460, IMAGE_SIZE[1] - 40)
+AVATAR_BOX_SIZE = (AVATAR_BOX[2] - AVATAR_BOX[0], AVATAR_BOX[3] - AVATAR_BOX[1])
+TITLE_POS, TITLE_FONT_SIZE = (40, 30), 38
+SUBTITLE_POS, SUBTITLE_FONT_SIZE = (40, 70), 20
+TEXT_LEFT, TEXT_TOP, TEXT_MARGIN = 500, 130, 40
+
+
+def scaled(value, scale: float):
+    """Pixel value(s) of the full-size layout at the given scale."""
+    if isinstance(value, tuple):
+        return tuple(round(v * scale) for v in value)
+    return round(value * scale)
+
+
+def variant_key(key: str, encoder: str, scale: float = 1.0) -> str:
+    """render_cache key of one encoding and size of the render with this render_key."""
+    if scale == 1.0:
+        return f"{key}-{encoder}"
+    return f"{key}-{encoder}-{scaled(IMAGE_SIZE[0], scale)}w"
+
+
+def create_avatar_image(title: str, behaviours, role: str, profile: str, filename: str = None,
+                        encoder: str = None, scale: float = 1.0):
+    """
+    Return the encoded avatar (and write it to filename if given), serving
+    it from render_cache when the same inputs were rendered before.
+
+    scale renders the whole layout at that fraction of IMAGE_SIZE, e.g. for
+    previews, instead of resizing a full-size render.
+    """
+    encoder = encoder or IMAGE_ENCODER
+    lexicon_version = lexicon.current().version
+    key = render_key(title, behaviours, role, profile, lexicon_version)
+    cache_key = variant_key(key, encoder, scale)
+    with timed("cache_lookup"):
+        data = render_cache.get(cache_key)
+    if data is None:
+        # Identical requests arriving together (a workshop submitting the
+        # example form) wait for one render instead of each starting their own.
+        data, shared = render_flights.do(cache_key, lambda: render_miss(
+            cache_key, lexicon_version, title, behaviours, role, profile, encoder, scale
+        ))
+        if shared:
+            metrics.inc("avatar_render_dedup_total", scope="process")
+
+    if filename:
+        atomic_write(filename, data)
+    return data
+
+
+def render_miss(cache_key: str, lexicon_version: str, title: str, behaviours, role: str,
+                profile: str, encoder: str, scale: float) -> bytes:
+    """Render a cache miss within this process's render capacity, and cache it."""
+    if render_service is not None:
+        # The service's renderers take the shared lock themselves; holding
+        # it here too would leave them waiting on us until it times out.
+        lock = contextlib.nullcontext(False)
+    else:
+        lock = shared_render_lock(cache_key)
+    with lock as waited:
+        if waited:
+            # Another worker held the lock, most likely rendering this very key.
+            data = render_cache.get(cache_key)
+            if data is not None:
+                metrics.inc("avatar_render_dedup_total", scope="workers")
+                return data
+
+        with admission.admit(render_cost(encoder, scale)):
+            metrics.inc("avatar_renders_in_flight")
+            try:
+                data = None
+                if render_service is not None:
+                    data = render_service.render(title, behaviours, role, profile, encoder, scale)
+                if data is None:
+                    data = render_avatar_bytes(title, behaviours, role, profile, encoder, scale)
+            finally:
+                metrics.inc("avatar_renders_in_flight", -1)
+
+        # If the lexicon was reloaded mid-render the image may not match the
+        # version in its key; hand it out but don't cache it.
+        if lexicon.current().version == lexicon_version:
+            with timed("cache_store"):
+                render_cache.put(cache_key, data)
+    return data
+
+
+def render_avatar_bytes(title: str, behaviours, role: str, profile: str, encoder: str = None,
+                        scale: float = 1.0) -> bytes:
+    encoder = encoder or IMAGE_ENCODER
+    backend = ENCODERS[encoder].get("backend", "raster")
+    img = draw_avatar_image(title, behaviours, role, profile, scale, backend)
+    with timed("encode"):
+        return encode_image(img, encoder)
+
+
+def draw_header(draw, origin, title: str, role: str, profile: str, scale: float):
+    """Title and subtitle, drawn relative to origin."""
+    ox, oy = origin
+    with timed("text"):
+        title_font = get_font(scaled(TITLE_FONT_SIZE, scale))
+        x, y = scaled(TITLE_POS, scale)
+        draw.text((x - ox, y - oy), title, font=title_font, fill=(34, 46, 80))
+
+        subtitle_font = get_font(scaled(SUBTITLE_FONT_SIZE, scale))
+        subtitle = f"{role.capitalize()} - {profile.capitalize()} profile"
+        x, y = scaled(SUBTITLE_POS, scale)
+        draw.text((x - ox, y - oy), subtitle, font=subtitle_font, fill=(90, 104, 128))
+
+
+def draw_behaviour_text(draw, origin, region, behaviours, scale: float):
+    """The behaviour lines laid out in region (minus the margin), drawn relative to origin."""
+    ox, oy = origin
+    text_left, text_top, right, bottom = region
+    max_width = right - text_left - scaled(TEXT_MARGIN, scale)
+    max_height = bottom - text_top - scaled(TEXT_MARGIN, scale)
+    font_sizes = tuple(scaled(size, scale) for size in BEHAVIOUR_FONT_SIZES)
+    x = text_left - ox
 
     if behaviours:
-        for b in behaviours:
-            b = b.strip()
-            if not b:
-                continue
-            words = b.split()
-            line = ""
-            for w in words:
-                test_line = (line + " " + w).strip()
-                # Pillow 10+: use textbbox instead of textsize
-                bbox = draw.textbbox((0, 0), test_line, font=behaviour_font)
-                w_width = bbox[2] - bbox[0]
-                if w_width > max_width and line:
-                    draw.text((text_left, y), "• " + line,
-                              font=behaviour_font, fill=(20, 20, 20))
-                    y += line_spacing
-                    line = w
-                else:
-                    line = test_line
-            if line:
-                draw.text((text_left, y), "• " + line,
+        with timed("layout"):
+            layout = fit_behaviours(behaviours, max_width, max_height, font_sizes)
+        with timed("text"):
+            behaviour_font = get_font(layout["font_size"])
+            y = text_top - oy
+            for line in layout["lines"]:
+                draw.text((x, y), "• " + line,
                           font=behaviour_font, fill=(20, 20, 20))
-                y += line_spacing
+                y += layout["line_spacing"]
+            if layout["hidden_lines"]:
+                draw.text((x, y), f"… and {layout['hidden_lines']} more lines",
+                          font=behaviour_font, fill=(120, 120, 120))
     else:
-        draw.text((text_left, y), "No behaviours entered.",
+        behaviour_font = get_font(font_sizes[0])
+        draw.text((x, text_top - oy), "No behaviours entered.",
                   font=behaviour_font, fill=(120, 120, 120))
 
-    img.save(filename)
+
+def draw_avatar_image(title: str, behaviours, role: str, profile: str,
+                      scale: float = 1.0, backend: str = "raster"):
+    """
+    Create a full avatar image with figure on the left and behaviours on the right.
+
+    Returns a PIL image for the raster backend and an SvgDraw for "svg".
+    """
+    img_w, img_h = scaled(IMAGE_SIZE, scale)
+    canvas = DRAW_BACKENDS[backend]((img_w, img_h))
+
+    # Traits & avatar. The sprite and the text layers each carry their own
+    # background; their regions don't overlap, so the paste order is free.
+    with timed("traits"):
+        traits = analyze_behaviours(behaviours, role, profile)
+    with timed("figure"):
+        canvas.figure(scaled(AVATAR_BOX, scale), traits, scale)
+
+    # Title and subtitle above the avatar box; behaviours on the right side.
+    header_region = (0, 0, img_w, scaled(AVATAR_BOX[1], scale))
+    canvas.layer(
+        "header", (title, role, profile, scale), header_region,
+        lambda draw, origin: draw_header(draw, origin, title, role, profile, scale),
+    )
+
+    text_region = (scaled(TEXT_LEFT, scale), scaled(TEXT_TOP, scale), img_w, img_h)
+    lines = tuple(b.strip() for b in behaviours if b.strip())
+    canvas.layer(
+        "text", (bool(behaviours), lines, scale), text_region,
+        lambda draw, origin: draw_behaviour_text(draw, origin, text_region, behaviours, scale),
+    )
+
+    return canvas.result()
+
+
+# =========================
+# RENDER SERVICE
+# =========================
+
+# With AVATAR_RENDER_SERVICE set to the socket of a running render_service.py,
+# render cache misses are rendered by its long-lived renderer processes
+# instead of in this worker. Each renderer owns a shared memory arena: it
+# writes the encoded image there and only (arena, size) crosses the socket.
+# Requests and replies are JSON, never pickles, so a process that can reach
+# the socket can ask for renders but not run code in either process.
+# If the service is unreachable this worker renders locally for a while.
+RENDER_SERVICE_SOCKET = os.environ.get("AVATAR_RENDER_SERVICE", "")
+RENDER_SERVICE_TIMEOUT = 30.0        # seconds to wait for one render
+RENDER_SERVICE_RETRY_SECONDS = 5.0   # local rendering after a failure, before retrying
+RENDER_SERVICE_MAX_ARENAS = 64       # attached arenas kept open per process
+
+
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """Attach to a segment owned by another process, without adopting it."""
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        # Otherwise this process's resource tracker unlinks the segment when
+        # it exits, out from under the renderer that owns it.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class RenderServiceClient:
+    """Sends renders to render_service.py; one connection per render."""
+
+    def __init__(self, address: str, timeout: float):
+        self.address = address
+        self.timeout = timeout
+        self._arenas = OrderedDict()  # name -> SharedMemory
+        self._lock = threading.Lock()
+        self._down_until = 0.0
+
+    def render(self, title: str, behaviours, role: str, profile: str, encoder: str,
+               scale: float = 1.0):
+        """Encoded image bytes, or None if the caller should render locally."""
+        if time.monotonic() < self._down_until:
+            return None
+        request = {
+            "title": title,
+            "behaviours": list(behaviours),
+            "role": role,
+            "profile": profile,
+            "encoder": encoder,
+            "scale": scale,
+        }
+        try:
+            with timed("render_service"), Client(self.address, family="AF_UNIX") as conn:
+                conn.send_bytes(json.dumps(request).encode("utf-8"))
+                if not conn.poll(self.timeout):
+                    raise TimeoutError(f"no answer within {self.timeout:g}s")
+                reply = json.loads(conn.recv_bytes())
+                if reply[0] == "shm":
+                    _, name, size = reply
+                    data = bytes(self._arena(name).buf[:size])
+                    conn.send_bytes(b"ok")  # copied out: the renderer may reuse its arena
+                elif reply[0] == "bytes":
+                    data = conn.recv_bytes()
+                else:
+                    # The render itself failed; rendering locally raises the same error.
+                    app.logger.warning("Render service failed on %r: %s", title, reply[1])
+                    metrics.inc("avatar_render_service_requests_total", result="error")
+                    return None
+        except (OSError, EOFError, TimeoutError, ValueError) as exc:
+            app.logger.warning("Render service at %s unavailable (%s); rendering locally "
+                               "for %gs", self.address, exc, RENDER_SERVICE_RETRY_SECONDS)
+            metrics.inc("avatar_render_service_requests_total", result="unavailable")
+            self._down_until = time.monotonic() + RENDER_SERVICE_RETRY_SECONDS
+            return None
+        metrics.inc("avatar_render_service_requests_total", result="ok")
+        return data
+
+    def _arena(self, name: str) -> shared_memory.SharedMemory:
+        with self._lock:
+            arena = self._arenas.get(name)
+            if arena is None:
+                arena = self._arenas[name] = attach_shared_memory(name)
+                # Renderers that were restarted leave stale arenas behind.
+                while len(self._arenas) > RENDER_SERVICE_MAX_ARENAS:
+                    self._arenas.popitem(last=False)[1].close()
+            else:
+                self._arenas.move_to_end(name)
+            return arena
+
+
+render_service = (
+    RenderServiceClient(RENDER_SERVICE_SOCKET, RENDER_SERVICE_TIMEOUT)
+    if RENDER_SERVICE_SOCKET else None
+)
+
+
+# =========================
+# RENDER CACHE
+# =========================
+
+OUTPUT_FOLDER = "avatars_web_output"
+RENDER_CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, "cache")
+RENDER_CACHE_MAX_ITEMS = 128                     # in-memory LRU tier
+RENDER_CACHE_MAX_DISK_BYTES = 200 * 1024 * 1024  # on-disk tier
+# Eviction goes down to this share of the limit, so a full disk tier isn't
+# rescanned on every put (like STORAGE_LOW_WATER).
+RENDER_CACHE_LOW_WATER = 0.9
+# Shared by all workers on the host; see RESULTS before turning it off.
+RENDER_CACHE_DISK = os.environ.get("AVATAR_RENDER_CACHE_DISK", "1") == "1"
+
+# Bump whenever the drawing code changes so old cache entries stop matching.
+RENDER_VERSION = "3"
+
+
+def render_key(title: str, behaviours, role: str, profile: str,
+               lexicon_version: str = None) -> str:
+    """
+    Content hash of everything that affects the rendered image.
+
+    Behaviour lines are stripped and blank lines dropped, exactly as the
+    drawing code does, so inputs that differ only in that respect share a key.
+    An empty list is kept distinct since it renders "No behaviours entered.".
+    The lexicon version is part of the key, so renders made with an older
+    lexicon stop matching as soon as a new one is loaded.
+    """
+    lines = [b.strip() for b in behaviours or []]
+    payload = json.dumps(
+        {
+            "version": RENDER_VERSION,
+            "lexicon": lexicon_version or lexicon.current().version,
+            "title": title,
+            "role": role,
+            "profile": profile,
+            "behaviours": [b for b in lines if b],
+            "has_behaviours": bool(behaviours),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class RenderCache:
+    """
+    Two-tier cache of rendered PNG bytes keyed by render_key().
+
+    The memory tier is a bounded LRU; the disk tier keeps one file per key
+    and, once it grows past max_disk_bytes, evicts the least recently used
+    files down to RENDER_CACHE_LOW_WATER of it. The folder is scanned without
+    holding the lock, so memory hits never wait on disk I/O. With folder=None
+    the cache stays in memory only.
+    """
+
+    def __init__(self, folder: str, max_items: int, max_disk_bytes: int):
+        self.folder = folder
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._memory = OrderedDict()
+        self._disk_bytes = None
+        self._evicting = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key + ".img")
+
+    def get(self, key: str):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return data
+            if self.folder is None:
+                self.stats["misses"] += 1
+                return None
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # keep the disk tier in LRU order
+        except OSError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        with self._lock:
+            self.stats["disk_hits"] += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._remember(key, data)
+        if self.folder is None:
+            return
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._path(key)
+        atomic_write(path, data)
+
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+            # One thread scans at a time; the others just write.
+            scan = over and not self._evicting
+            if scan:
+                self._evicting = True
+        if scan:
+            try:
+                self._evict_disk()
+            finally:
+                with self._lock:
+                    self._evicting = False
+
+    def _remember(self, key: str, data: bytes):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _disk_entries(self):
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if not entry.name.endswith(".tmp"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self):
+        """Called without self._lock; takes it only to publish the results."""
+        # Rescan rather than trust the running total: other worker processes
+        # write to the same folder.
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        if total > self.max_disk_bytes:
+            target = self.max_disk_bytes * RENDER_CACHE_LOW_WATER
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+        with self._lock:
+            # Puts that landed during the scan may or may not be in it; the
+            # next scan corrects any drift.
+            self._disk_bytes = total
+            self.stats["evictions"] += evicted
+
+
+render_cache = RenderCache(
+    RENDER_CACHE_FOLDER if RENDER_CACHE_DISK else None,
+    RENDER_CACHE_MAX_ITEMS,
+    RENDER_CACHE_MAX_DISK_BYTES,
+)
+
+
+@metrics.collector
+def _collect_cache_metrics(m: Metrics):
+    stats = dict(render_cache.stats)
+    m.set("avatar_cache_lookups_total", stats["memory_hits"], cache="render", result="memory_hit")
+    m.set("avatar_cache_lookups_total", stats["disk_hits"], cache="render", result="disk_hit")
+    m.set("avatar_cache_lookups_total", stats["misses"], cache="render", result="miss")
+    m.set("avatar_cache_evictions_total", stats["evictions"], cache="render")
+    layout_info = wrap_lines.cache_info()
+    m.set("avatar_cache_lookups_total", layout_info.hits, cache="layout", result="hit")
+    m.set("avatar_cache_lookups_total", layout_info.misses, cache="layout", result="miss")
+    m.set("avatar_cache_entries", len(render_cache), cache="render")
+    m.set("avatar_cache_entries", layout_info.currsize, cache="layout")
+    m.set("avatar_cache_entries", len(_figure_sprites), cache="sprite")
+    m.set("avatar_cache_entries", len(layer_cache), cache="layer")
+    trait_stats = dict(trait_cache.stats)
+    m.set("avatar_cache_lookups_total", trait_stats["memory_hits"],
+          cache="traits", result="memory_hit")
+    m.set("avatar_cache_lookups_total", trait_stats["shared_hits"],
+          cache="traits", result="shared_hit")
+    m.set("avatar_cache_lookups_total", trait_stats["misses"], cache="traits", result="miss")
+    m.set("avatar_cache_entries", len(trait_cache), cache="traits")
+    m.set("avatar_cache_entries", trait_cache.shared_rows(), cache="traits_shared")
+    m.set("avatar_cache_hit_ratio", trait_cache.hit_ratio(), cache="traits")
+    m.set("avatar_cache_entries", len(result_store), cache="results")
+
+
+preload_fonts()
+app.logger.info("Using font: %s", font_info()["path"] or "Pillow default")
+
+if os.environ.get("AVATAR_WARMUP_SPRITES") == "1":
+    app.logger.info("Pre-rendered %d figure sprites", warm_figure_sprites())
+
+
+# =========================
+# RENDER ADMISSION
+# =========================
+
+# Each process renders at most RENDER_CAPACITY full-size raster renders'
+# worth at once; previews and SVGs count for the fraction of that they cost.
+# Beyond that, up to RENDER_MAX_WAITING renders queue for RENDER_ADMIT_SECONDS
+# and the rest are refused, so an overloaded worker answers 503 with
+# Retry-After instead of piling requests up until gunicorn's timeout.
+RENDER_CAPACITY = float(os.environ.get("AVATAR_RENDER_CAPACITY", "4"))
+RENDER_MAX_WAITING = 8
+RENDER_ADMIT_SECONDS = 2.0
+RENDER_RETRY_AFTER_SECONDS = 2
+# Cross-process dedup: a worker about to render takes one of these file
+# locks (by key) so other workers wait and then find the result in the disk
+# cache. Striped so the folder stays small; a collision only costs a wait.
+RENDER_LOCK_FOLDER = os.path.join(OUTPUT_FOLDER, "locks")
+RENDER_LOCK_STRIPES = 256
+RENDER_LOCK_WAIT_SECONDS = 10.0
+
+
+class RenderOverloaded(Exception):
+    """This process is at its render capacity."""
+
+
+def render_cost(encoder: str, scale: float) -> float:
+    """Cost relative to a full-size raster render (measured with bench.py)."""
+    cost = scale * scale
+    if ENCODERS[encoder].get("backend") == "svg":
+        cost *= 0.1
+    return cost
+
+
+class RenderAdmission:
+    """Cost-weighted concurrency limit with a short, bounded queue."""
+
+    def __init__(self, capacity: float, max_waiting: int, timeout: float):
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.running = 0.0
+        self.waiting = 0
+        self._changed = threading.Condition()
+
+    def saturated(self) -> bool:
+        """True if a new render would be refused right away."""
+        with self._changed:
+            return self.running >= self.capacity and self.waiting >= self.max_waiting
+
+    @contextlib.contextmanager
+    def admit(self, cost: float):
+        with self._changed:
+            if not self._fits(cost):
+                if self.waiting >= self.max_waiting:
+                    metrics.inc("avatar_render_rejections_total")
+                    raise RenderOverloaded()
+                self.waiting += 1
+                try:
+                    with timed("admission_wait"):
+                        admitted = self._changed.wait_for(lambda: self._fits(cost), self.timeout)
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    metrics.inc("avatar_render_rejections_total")
+                    raise RenderOverloaded()
+            self.running += cost
+        try:
+            yield
+        finally:
+            with self._changed:
+                self.running -= cost
+                self._changed.notify_all()
+
+    def _fits(self, cost: float) -> bool:
+        # A render larger than the whole capacity still runs, alone.
+        return self.running == 0 or self.running + cost <= self.capacity
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution of fn."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """(fn's result, whether it came from another caller's call)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+            return flight.result, False
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+@contextlib.contextmanager
+def shared_render_lock(key: str):
+    """
+    Hold this key's file lock while rendering; yields True if another worker
+    held it first. A no-op without the shared disk cache or fcntl.
+    """
+    if fcntl is None or render_cache.folder is None:
+        yield False
+        return
+    os.makedirs(RENDER_LOCK_FOLDER, exist_ok=True)
+    stripe = int(key[:8], 16) % RENDER_LOCK_STRIPES
+    with open(os.path.join(RENDER_LOCK_FOLDER, f"render-{stripe:03d}.lock"), "a") as f:
+        waited = False
+        deadline = time.monotonic() + RENDER_LOCK_WAIT_SECONDS
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                waited = True
+                if time.monotonic() > deadline:
+                    # Stuck holder: render without the lock rather than hang.
+                    yield True
+                    return
+                time.sleep(0.02)
+        try:
+            yield waited
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+admission = RenderAdmission(RENDER_CAPACITY, RENDER_MAX_WAITING, RENDER_ADMIT_SECONDS)
+render_flights = SingleFlight()
+
+
+@metrics.collector
+def _collect_render_load(m: Metrics):
+    m.set("avatar_render_load", admission.running, state="running")
+    m.set("avatar_render_load", admission.waiting, state="waiting")
+
+
+# =========================
+# TRAIT CACHE
+# =========================
+
+TRAIT_CACHE_MAX_ITEMS = 4096              # in-memory LRU tier
+TRAIT_CACHE_MAX_SHARED_ROWS = 100000      # optional SQLite tier shared by all workers
+TRAIT_CACHE_SHARED = os.environ.get("AVATAR_TRAIT_CACHE_SHARED", "0") == "1"
+# Kept out of RENDER_CACHE_FOLDER, whose eviction treats every file as a render.
+TRAIT_CACHE_DB = os.path.join(OUTPUT_FOLDER, "traits", "traits.sqlite3")
+TRAIT_CACHE_TRIM_EVERY = 256              # inserts between size checks
+
+
+class TraitCache:
+    """
+    Two-tier memo of compute_traits() keyed by normalized input.
+
+    The memory tier is a per-process LRU. The optional shared tier is a SQLite
+    table that every worker on the host reads and writes, trimmed to max_rows
+    oldest first. A lookup there costs more than compute_traits() itself, so
+    it only pays off when analysis gets more expensive (a larger lexicon); it
+    is off unless AVATAR_TRAIT_CACHE_SHARED=1. With db_path=None the cache
+    stays in memory only; a broken database disables the shared tier instead
+    of failing renders, while a busy one just counts as a miss.
+    """
+
+    def __init__(self, db_path: str, max_items: int, max_rows: int):
+        self.db_path = db_path
+        self.max_items = max_items
+        self.max_rows = max_rows
+        self.stats = {"memory_hits": 0, "shared_hits": 0, "misses": 0}
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()  # the memory tier and stats; never held for I/O
+        self._local = threading.local()
+        self._inserts = itertools.count(1)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def key(self, lines: tuple, role: str, profile: str, matcher: TraitMatcher) -> str:
+        payload = json.dumps([matcher.version, role, profile, lines], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+    def hit_ratio(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["shared_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def get_or_compute(self, lines: tuple, role: str, profile: str) -> dict:
+        # One matcher for the key and the analysis, even if it is swapped meanwhile.
+        matcher = lexicon.current()
+        key = self.key(lines, role, profile, matcher)
+        with self._lock:
+            traits = self._memory.get(key)
+            if traits is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return traits
+
+        traits = self._shared_get(key)
+        if traits is not None:
+            with self._lock:
+                self.stats["shared_hits"] += 1
+                self._remember(key, traits)
+            return traits
+
+        traits = compute_traits(lines, role, profile, matcher)
+        with self._lock:
+            self.stats["misses"] += 1
+            self._remember(key, traits)
+        self._shared_put(key, traits)
+        return traits
+
+    def shared_rows(self) -> int:
+        db = self._connect()
+        if db is None:
+            return 0
+        try:
+            return db.execute("SELECT COUNT(*) FROM traits").fetchone()[0]
+        except sqlite3.Error as exc:
+            self._failed(exc)
+            return 0
+
+    def _remember(self, key: str, traits: dict):
+        self._memory[key] = traits
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    # Shared tier: one connection per thread, so lookups run concurrently.
+
+    def _connect(self):
+        if self.db_path is None:
+            return None
+        local = self._local
+        if getattr(local, "db", None) is not None and local.pid == os.getpid():
+            return local.db
+        # A connection must not cross a fork, so each worker opens its own.
+        try:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            # Waiting longer on a busy database than recomputing would take is pointless.
+            db = sqlite3.connect(self.db_path, timeout=0.05, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS traits "
+                       "(key TEXT PRIMARY KEY, traits TEXT NOT NULL, used REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS traits_used ON traits (used)")
+        except sqlite3.Error as exc:
+            self._failed(exc)
+            return None
+        local.db, local.pid = db, os.getpid()
+        return db
+
+    def _failed(self, exc: Exception):
+        message = str(exc)
+        if "locked" in message or "busy" in message:
+            return  # another worker is writing; try again next time
+        app.logger.warning("Shared trait cache %s disabled: %s", self.db_path, exc)
+        self.db_path = None
+
+    def _shared_get(self, key: str):
+        db = self._connect()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT traits FROM traits WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as exc:
+            self._failed(exc)
+            return None
+        return None if row is None else json.loads(row[0])
+
+    def _shared_put(self, key: str, traits: dict):
+        db = self._connect()
+        if db is None:
+            return
+        try:
+            db.execute("INSERT OR REPLACE INTO traits (key, traits, used) VALUES (?, ?, ?)",
+                       (key, json.dumps(traits), time.time()))
+            if next(self._inserts) % TRAIT_CACHE_TRIM_EVERY == 0:
+                db.execute(
+                    "DELETE FROM traits WHERE key IN (SELECT key FROM traits ORDER BY used "
+                    "LIMIT MAX((SELECT COUNT(*) FROM traits) - ?, 0))",
+                    (self.max_rows,),
+                )
+        except sqlite3.Error as exc:
+            self._failed(exc)
+
+
+trait_cache = TraitCache(
+    TRAIT_CACHE_DB if TRAIT_CACHE_SHARED else None,
+    TRAIT_CACHE_MAX_ITEMS,
+    TRAIT_CACHE_MAX_SHARED_ROWS,
+)
+
+
+# =========================
+# INPUT LIMITS
+# =========================
+
+# Checked before anything is analysed or drawn. Text within the limits that
+# doesn't fit the image is summarised on it ("… and N more lines").
+MAX_TITLE_CHARS = 100
+MAX_BEHAVIOUR_LINES = int(os.environ.get("AVATAR_MAX_BEHAVIOUR_LINES", "60"))
+MAX_LINE_CHARS = int(os.environ.get("AVATAR_MAX_LINE_CHARS", "300"))
+MAX_REQUEST_BYTES = int(os.environ.get("AVATAR_MAX_REQUEST_BYTES", str(4 * 1024 * 1024)))
+
+# Werkzeug refuses larger bodies (and, from Flask/Werkzeug 3.1, larger
+# multipart fields) before parsing them, so a pasted document is never buffered. A field within the
+# limits may still be all 4-byte UTF-8, and x3 once percent-encoded.
+MAX_FIELD_BYTES = 4 * MAX_BEHAVIOUR_LINES * (MAX_LINE_CHARS + 1)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+app.config["MAX_FORM_MEMORY_SIZE"] = MAX_FIELD_BYTES
+
+
+class InputTooLarge(ValueError):
+    """An input over one of the limits; reason labels the metric."""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+        metrics.inc("avatar_input_rejections_total", reason=reason)
+
+
+def check_input_limits(title: str, behaviours):
+    """Raise InputTooLarge if the title or behaviour lines are over the limits."""
+    if len(title) > MAX_TITLE_CHARS:
+        raise InputTooLarge(
+            "title", f"The title has {len(title)} characters; the limit is {MAX_TITLE_CHARS}."
+        )
+    # Measured as drawn: without surrounding whitespace, including the "\r"
+    # browsers leave on every textarea line but the last.
+    lines = [b.strip() for b in behaviours if b.strip()]
+    if len(lines) > MAX_BEHAVIOUR_LINES:
+        raise InputTooLarge(
+            "lines",
+            f"There are {len(lines)} behaviour lines; the limit is {MAX_BEHAVIOUR_LINES}.",
+        )
+    longest = max(map(len, lines), default=0)
+    if longest > MAX_LINE_CHARS:
+        raise InputTooLarge(
+            "line_length",
+            f"A behaviour line has {longest} characters; the limit is {MAX_LINE_CHARS}.",
+        )
+
+
+# =========================
+# BATCH GENERATION
+# =========================
+
+BATCH_MAX_ROWS = 1000
+BATCH_WORKERS = os.cpu_count() or 1
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """Process pool shared by batch renders, started on first use."""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn, not fork: the web server may have threads running.
+            _render_pool = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _render_pool
+
+
+def reset_render_pool(broken: ProcessPoolExecutor):
+    """
+    Drop a pool that can no longer render: one whose child died (e.g. was
+    OOM-killed) stays broken for good. The next get_render_pool() starts a
+    new one.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is broken:
+            app.logger.warning("Batch render pool is broken, starting a new one")
+            _render_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def submit_render(pool: ProcessPoolExecutor, fn, *args) -> Future:
+    """
+    pool.submit(fn, *args), retried once on a new pool if this one is broken
+    or shut down. If that fails too, the returned future holds the error, so
+    one row fails instead of the response being cut off.
+    """
+    for _ in range(2):
+        try:
+            return pool.submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError) as exc:
+            error = exc
+            reset_render_pool(pool)
+            pool = get_render_pool()
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+def normalize_batch_row(row: dict) -> dict:
+    """Apply the same defaults and cleanup as the /generate form."""
+    behaviours = row.get("behaviours") or []
+    if isinstance(behaviours, str):
+        # CSV cells: one behaviour per line, or separated by "|"
+        behaviours = re.split(r"\n|\|", behaviours)
+    elif not isinstance(behaviours, list):
+        raise ValueError("'behaviours' must be a string or list")
+    row = {
+        "title": str(row.get("title") or "").strip() or "Avatar",
+        "role": str(row.get("role") or "mentor").strip().lower(),
+        "profile": str(row.get("profile") or "mixed").strip().lower(),
+        "behaviours": [str(b) for b in behaviours],
+    }
+    check_input_limits(row["title"], row["behaviours"])
+    return row
+
+
+def parse_batch_rows(data: str, is_json: bool):
+    """Read a JSON list of objects or a CSV with a header row."""
+    if is_json:
+        rows = json.loads(data)
+        if isinstance(rows, dict):
+            rows = rows.get("rows")
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("JSON input must be a list of objects")
+    else:
+        reader = csv.DictReader(io.StringIO(data))
+        if not reader.fieldnames or "title" not in reader.fieldnames:
+            raise ValueError("CSV input needs a header row with at least a 'title' column")
+        rows = list(reader)
+
+    if not rows:
+        raise ValueError("No rows to render")
+    if len(rows) > BATCH_MAX_ROWS:
+        raise ValueError(f"Too many rows ({len(rows)}), the limit is {BATCH_MAX_ROWS}")
+    normalized = []
+    for number, row in enumerate(rows, 1):
+        try:
+            normalized.append(normalize_batch_row(row))
+        except ValueError as exc:
+            raise ValueError(f"row {number}: {exc}") from exc
+    return normalized
+
+
+def render_batch_row(row: dict):
+    """Pool worker: render one row, returning (png bytes, traits)."""
+    data = create_avatar_image(row["title"], row["behaviours"], row["role"], row["profile"])
+    traits = analyze_behaviours(row["behaviours"], row["role"], row["profile"])
+    return data, traits
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable sink for zipfile; drain() hands back what was written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_batch_results(rows, pool, window: int):
+    """
+    Yield (index, png bytes or None, traits or None, error) as renders finish.
+
+    At most `window` renders are in flight, so a slow client never makes
+    finished images pile up in memory.
+    """
+    pending = {}
+    next_index = 0
+    while next_index < len(rows) or pending:
+        while next_index < len(rows) and len(pending) < window:
+            pending[submit_render(pool, render_batch_row, rows[next_index])] = next_index
+            next_index += 1
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            try:
+                data, traits = future.result()
+            except Exception as exc:
+                if isinstance(exc, BrokenProcessPool):
+                    reset_render_pool(pool)
+                yield index, None, None, str(exc) or exc.__class__.__name__
+            else:
+                yield index, data, traits, None
+
+
+def stream_batch_zip(rows, pool, window: int):
+    """Yield a ZIP of the rendered PNGs plus manifest.json, one file at a time."""
+    stream = _ZipStream()
+    manifest = []
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as zf:
+        for index, data, traits, error in iter_batch_results(rows, pool, window):
+            row = rows[index]
+            entry = {
+                "index": index,
+                "title": row["title"],
+                "role": row["role"],
+                "profile": row["profile"],
+            }
+            if error:
+                entry["error"] = error
+            else:
+                name = f"{index + 1:04d}_{safe_filename(row['title'])}"
+                zf.writestr(name, data)
+                entry.update(
+                    file=name,
+                    bytes=len(data),
+                    sha256=hashlib.sha256(data).hexdigest(),
+                    traits=traits,
+                )
+            manifest.append(entry)
+            yield stream.drain()
+
+        manifest.sort(key=lambda e: e["index"])
+        zf.writestr("manifest.json", json.dumps(manifest, indent=2, ensure_ascii=False))
+    yield stream.drain()
+
+
+# =========================
+# OUTPUT STORAGE
+# =========================
+
+# Persisted results live in STORAGE_FOLDER, sharded into subfolders by the
+# first two hex digits of their render key. A file's atime is set whenever
+# it is downloaded; the sweeper deletes files nobody downloaded within the
+# TTL, then the least recently downloaded ones while either quota is exceeded.
+STORAGE_FOLDER = os.path.join(OUTPUT_FOLDER, "files")
+STORAGE_MAX_BYTES = 1024 * 1024 * 1024
+STORAGE_MAX_FILES = 100000
+STORAGE_TTL_SECONDS = 30 * 24 * 3600
+STORAGE_SWEEP_SECONDS = 300
+# An over-quota sweep evicts down to this share of the limits, so a full
+# folder isn't swept again for every new file.
+STORAGE_LOW_WATER = 0.9
+
+
+class OutputStorage:
+    """
+    Files on disk by output name, bounded by size, count and TTL.
+
+    Every worker process runs a sweeper thread; an flock on the folder lets
+    only one of them sweep at a time. Files written by older versions
+    straight into OUTPUT_FOLDER, content-addressed or plain "Title.png", are
+    moved into their shard on the first sweep (or when first downloaded), and
+    from then on are served, counted and swept like any other.
+    """
+
+    def __init__(self, folder: str, max_bytes: int, max_files: int, ttl_seconds: int,
+                 sweep_seconds: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.ttl_seconds = ttl_seconds
+        self.sweep_seconds = sweep_seconds
+        self.stats = {"files": 0, "bytes": 0, "expired": 0, "evicted": 0, "sweeps": 0,
+                      "last_sweep": None, "last_sweep_seconds": None}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sweeper_pid = None
+
+    def path(self, name: str):
+        """Where a file of this name is kept, or None if the name is unsafe."""
+        parsed = parse_output_name(name)
+        shard = parsed[1][:2] if parsed else hashlib.sha256(name.encode("utf-8")).hexdigest()[:2]
+        return safe_join(os.path.abspath(self.folder), shard, name)
+
+    def write(self, name: str, data: bytes):
+        path = self.path(name)
+        if path is None:
+            raise ValueError(f"Invalid output name {name!r}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        existed = os.path.exists(path)
+        atomic_write(path, data)
+        with self._lock:
+            if not existed:
+                self.stats["files"] += 1
+                self.stats["bytes"] += len(data)
+            over_quota = (self.stats["bytes"] > self.max_bytes
+                          or self.stats["files"] > self.max_files)
+        self.start_sweeper()
+        if over_quota:
+            self._wake.set()
+
+    def read(self, name: str):
+        """(bytes, mtime) of a stored file, or (None, None). Counts as a download."""
+        path = self.path(name)
+        if path is None:
+            return None, None
+        if not os.path.exists(path):
+            self._adopt_legacy_file(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+                st = os.fstat(f.fileno())
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            return None, None
+        self.start_sweeper()
+        return data, st.st_mtime
+
+    def touch(self, name: str):
+        """Record a download of a file served from memory instead of disk."""
+        path = self.path(name)
+        if path is None:
+            return
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except OSError:
+            pass
+
+    def start_sweeper(self):
+        """Start this process's sweeper thread, once (again after a fork)."""
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_forever, name="storage-sweeper", daemon=True).start()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                app.logger.exception("Sweeping %s failed", self.folder)
+            self._wake.wait(self.sweep_seconds)
+            self._wake.clear()
+
+    @contextlib.contextmanager
+    def _sweep_lock(self):
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.folder, ".sweep.lock"), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False  # another worker is sweeping
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def sweep(self):
+        """Expire, then evict down to the quotas. Returns (expired, evicted) counts."""
+        os.makedirs(self.folder, exist_ok=True)
+        with self._sweep_lock() as locked:
+            if not locked:
+                return 0, 0
+            started = time.perf_counter()
+            self._adopt_legacy_files()
+
+            cutoff = time.time_ns() - self.ttl_seconds * 1_000_000_000
+            expired = evicted = 0
+            kept = []
+            for atime, size, path in self._entries():
+                if atime < cutoff and self._remove(path):
+                    expired += 1
+                else:
+                    kept.append((atime, size, path))
+
+            total = sum(size for _, size, _ in kept)
+            count = len(kept)
+            if total > self.max_bytes or count > self.max_files:
+                target_bytes = self.max_bytes * STORAGE_LOW_WATER
+                target_files = self.max_files * STORAGE_LOW_WATER
+                for _, size, path in sorted(kept):
+                    if total <= target_bytes and count <= target_files:
+                        break
+                    if self._remove(path):
+                        total -= size
+                        count -= 1
+                        evicted += 1
+
+            with self._lock:
+                self.stats.update(files=count, bytes=total, last_sweep=time.time(),
+                                  last_sweep_seconds=time.perf_counter() - started)
+                self.stats["expired"] += expired
+                self.stats["evicted"] += evicted
+                self.stats["sweeps"] += 1
+        if expired or evicted:
+            app.logger.info("Storage sweep: %d expired, %d evicted, %d files / %d bytes left",
+                            expired, evicted, count, total)
+        return expired, evicted
+
+    def footprint(self) -> dict:
+        """A fresh scan of what is on disk, with the limits and sweep stats."""
+        entries = self._entries() if os.path.isdir(self.folder) else []
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            "folder": self.folder,
+            "files": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "oldest_download": min((a for a, _, _ in entries), default=0) / 1e9 or None,
+            "max_bytes": self.max_bytes,
+            "max_files": self.max_files,
+            "ttl_seconds": self.ttl_seconds,
+            "expired": stats["expired"],
+            "evicted": stats["evicted"],
+            "sweeps": stats["sweeps"],
+            "last_sweep": stats["last_sweep"],
+            "last_sweep_seconds": stats["last_sweep_seconds"],
+        }
+
+    def _entries(self):
+        """(atime ns, size, path) of every stored file."""
+        entries = []
+        with os.scandir(self.folder) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as it:
+                    for entry in it:
+                        if entry.name.endswith(".tmp"):
+                            continue
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((st.st_atime_ns, st.st_size, entry.path))
+        return entries
+
+    def _adopt_legacy_files(self):
+        parent = os.path.dirname(os.path.abspath(self.folder))
+        with os.scandir(parent) as it:
+            legacy = [
+                e.name for e in it
+                if e.is_file() and not e.name.startswith(".")
+                and e.name.rsplit(".", 1)[-1] in OUTPUT_FORMATS
+            ]
+        for name in legacy:
+            self._adopt_legacy_file(name)
+
+    def _adopt_legacy_file(self, name: str):
+        """Move OUTPUT_FOLDER/<name>, if there is one, into its shard."""
+        parent = os.path.dirname(os.path.abspath(self.folder))
+        legacy_path = safe_join(parent, name)
+        path = self.path(name)
+        if legacy_path is None or path is None or not os.path.isfile(legacy_path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(legacy_path, path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        return True
+
+
+output_storage = OutputStorage(
+    STORAGE_FOLDER,
+    STORAGE_MAX_BYTES,
+    STORAGE_MAX_FILES,
+    STORAGE_TTL_SECONDS,
+    STORAGE_SWEEP_SECONDS,
+)
+
+
+@metrics.collector
+def _collect_storage_metrics(m: Metrics):
+    stats = dict(output_storage.stats)
+    m.set("avatar_storage_bytes", stats["bytes"])
+    m.set("avatar_storage_files", stats["files"])
+    m.set("avatar_storage_removed_total", stats["expired"], reason="ttl")
+    m.set("avatar_storage_removed_total", stats["evicted"], reason="quota")
+    m.clear("avatar_lexicon_info")
+    m.set("avatar_lexicon_info", 1, version=lexicon.current().version)
+
+
+# =========================
+# RESULTS
+# =========================
+
+# Rendered images are kept in result_store and previews inlined into the
+# result page, so viewing a result reads no files. Renders still write the
+# full-size image and the preview to the render cache disk tier and take a
+# shared_render_lock; that tier is also how /download finds an image another
+# worker rendered, since result_store is per process. With
+# AVATAR_RENDER_CACHE_DISK=0 a render touches no files, but only a single
+# worker (or sticky sessions) can then serve its Download link. Set
+# AVATAR_PERSIST_OUTPUT=1 to also keep every result in output_storage.
+PERSIST_OUTPUT = os.environ.get("AVATAR_PERSIST_OUTPUT", "0") == "1"
+INLINE_PREVIEWS = os.environ.get("AVATAR_INLINE_PREVIEWS", "1") == "1"
+RESULT_STORE_MAX_BYTES = 64 * 1024 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Result page previews are rendered at the width they are shown at
+# (.avatar-preview max-width) rather than scaled down by the browser.
+PREVIEW_WIDTH = 380
+PREVIEW_SCALE = PREVIEW_WIDTH / IMAGE_SIZE[0]
+# Last-Modified for images served from memory. Content-addressed images
+# never change, so any time before they were first served will do.
+STARTED_AT = time.time()
+
+# Formats /generate can produce, by file extension: PNG files use the
+# configured raster encoder, SVG ones the vector backend.
+OUTPUT_FORMATS = {
+    "png": IMAGE_ENCODER,
+    "svg": "svg",
+}
+
+AVATAR_SLOTS = (
+    # form field suffix, default title, default role
+    ("a", "Avatar_A", "mentor"),
+    ("b", "Avatar_B", "trainee"),
+)
+# Body limit for /generate; see INPUT LIMITS.
+MAX_FORM_BYTES = len(AVATAR_SLOTS) * 3 * MAX_FIELD_BYTES
+
+
+class ByteStore:
+    """Bounded LRU of name -> bytes, limited by total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, name: str):
+        with self._lock:
+            data = self._items.get(name)
+            if data is not None:
+                self._items.move_to_end(name)
+            return data
+
+    def put(self, name: str, data: bytes):
+        with self._lock:
+            old = self._items.pop(name, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[name] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+result_store = ByteStore(RESULT_STORE_MAX_BYTES)
+
+
+def send_image(data: bytes, mimetype: str, download_name: str, as_attachment: bool,
+               immutable: bool, last_modified):
+    """
+    Send image bytes with a strong content ETag and Last-Modified, answering
+    If-None-Match / If-Modified-Since with 304 and Range with 206.
+
+    Content-addressed names never change meaning, so they are cached for a
+    year as immutable; anything else must be revalidated.
+    """
+    response = send_file(
+        io.BytesIO(data),
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        etag=hashlib.sha256(data).hexdigest(),
+        last_modified=last_modified,
+        max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        conditional=True,
+    )
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
+def transcode_cached(key: str, data: bytes, encoder: str, scale: float = 1.0) -> bytes:
+    """Re-encode an already rendered image, caching it like a fresh render."""
+    cache_key = variant_key(key, encoder, scale)
+    out = render_cache.get(cache_key)
+    if out is None:
+        with timed("transcode"):
+            img = Image.open(io.BytesIO(data))
+            out = encode_image(img.convert("RGB"), encoder)
+        render_cache.put(cache_key, out)
+    return out
+
+
+def data_uri(data: bytes, mimetype: str = "image/png") -> str:
+    return f"data:{mimetype};base64," + base64.b64encode(data).decode("ascii")
+
+
+def read_avatar_form(form, slot: str, default_title: str, default_role: str):
+    """Inputs for one avatar slot of the form, or None if it was left empty."""
+    title = (form.get(f"title_{slot}") or "").strip()
+    role = (form.get(f"role_{slot}") or default_role).strip().lower()
+    profile = (form.get(f"profile_{slot}") or "mixed").strip().lower()
+    behaviours_text = form.get(f"behaviours_{slot}") or ""
+
+    if not title and not behaviours_text.strip():
+        return None
+    behaviours = behaviours_text.split("\n")
+    check_input_limits(title, behaviours)
+    output_format = (form.get("format") or "png").strip().lower()
+    return {
+        "title": title or default_title,
+        "role": role,
+        "profile": profile,
+        "behaviours": behaviours,
+        "format": output_format if output_format in OUTPUT_FORMATS else "png",
+    }
+
+
+def render_result(spec: dict) -> dict:
+    """Render one avatar, keep it in result_store and return where to find it."""
+    title = spec["title"]
+    output_format = spec.get("format", "png")
+    key = render_key(title, spec["behaviours"], spec["role"], spec["profile"])
+    file_name = output_name(title, key, output_format)
+
+    encoder = OUTPUT_FORMATS[output_format]
+    data = create_avatar_image(
+        title, spec["behaviours"], spec["role"], spec["profile"], encoder=encoder
+    )
+    result_store.put(file_name, data)
+    if PERSIST_OUTPUT:
+        output_storage.write(file_name, data)
+    if ENCODERS[encoder].get("backend") == "svg":
+        # Vector output: the file itself is the preview.
+        preview = data
+        preview_url = f"/download/{file_name}?inline=1"
+    else:
+        preview = create_avatar_image(
+            title, spec["behaviours"], spec["role"], spec["profile"], scale=PREVIEW_SCALE
+        )
+        preview_url = f"/download/{file_name}?inline=1&size=preview"
+    return {
+        "title": title,
+        "file": file_name,
+        "format": output_format,
+        "mimetype": ENCODERS[encoder]["mimetype"],
+        "url": f"/download/{file_name}",
+        "preview_url": preview_url,
+        "data": data,
+        "preview": preview,
+    }
+
+
+def render_result_block(spec: dict, preview_encoder: str, order: int = 0) -> dict:
+    """
+    Render one avatar and return its block of the result page, with the
+    inline preview in preview_encoder (see negotiate_encoder()).
+    """
+    with render_report() as report:
+        result = render_result(spec)
+    title = result["title"]
+
+    if INLINE_PREVIEWS and result["format"] == "svg":
+        preview_src = data_uri(result["preview"], result["mimetype"])
+    elif INLINE_PREVIEWS:
+        encoder = preview_encoder
+        preview = result["preview"]
+        if encoder != IMAGE_ENCODER:
+            preview = create_avatar_image(
+                title, spec["behaviours"], spec["role"], spec["profile"],
+                encoder=encoder, scale=PREVIEW_SCALE,
+            )
+        preview_src = data_uri(preview, ENCODERS[encoder]["mimetype"])
+    else:
+        preview_src = result["preview_url"]
+
+    return {
+        "order": order,
+        "title": title,
+        "preview_src": preview_src,
+        "url": result["url"],
+        "format": result["format"],
+        "server_timing": format_server_timing(report["stages"]),
+        "layers": format_layers(report["layers"]),
+    }
+
+
+# Avatars of one /generate request render concurrently on these threads;
+# Pillow releases the GIL for most of the drawing and encoding.
+PAGE_RENDER_THREADS = 4
+_page_render_pool = ThreadPoolExecutor(max_workers=PAGE_RENDER_THREADS,
+                                       thread_name_prefix="page-render")
+
+
+def stream_result_page(specs, preview_encoder: str):
+    """
+    Yield the result page: the head at once, then each avatar's block as
+    soon as it has rendered, in completion order.
+    """
+    yield RESULT_PAGE_HEAD
+    futures = {
+        _page_render_pool.submit(render_result_block, spec, preview_encoder, order): (order, spec)
+        for order, spec in enumerate(specs)
+    }
+    for future in as_completed(futures):
+        try:
+            block = future.result()
+        except RenderOverloaded:
+            order, spec = futures[future]
+            block = {"order": order, "title": spec["title"],
+                     "error": "The server is busy. Please try again in a moment."}
+        except Exception:
+            order, spec = futures[future]
+            app.logger.exception("Rendering %r failed", spec["title"])
+            block = {"order": order, "title": spec["title"],
+                     "error": "This avatar could not be rendered. Please try again."}
+        yield result_block.render(block)
+    yield RESULT_PAGE_TAIL
+
+
+# =========================
+# GALLERY
+# =========================
+
+# A contact sheet of preview-sized tiles. Tiles come from the render cache
+# when they were rendered before; the rest are rendered in the batch process
+# pool, at most GALLERY_WINDOW ahead of the row being written. The PNG is
+# encoded and streamed one row of tiles at a time, so memory stays the same
+# for any grid size.
+GALLERY_MAX_TILES = BATCH_MAX_ROWS
+GALLERY_MAX_COLUMNS = 8
+GALLERY_GAP = 12
+GALLERY_BACKGROUND = (208, 215, 226)  # between tiles, whose own background is BACKGROUND_COLOR
+GALLERY_WINDOW = 2 * BATCH_WORKERS
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def parse_gallery_entries(items) -> list:
+    """
+    Normalize gallery entries: an output name (string or {"file": name}) of
+    an avatar rendered before, or {title, role, profile, behaviours} inputs.
+    """
+    if not isinstance(items, list):
+        raise ValueError("Expected a list of tiles")
+    if not items:
+        raise ValueError("No tiles to show")
+    if len(items) > GALLERY_MAX_TILES:
+        raise ValueError(f"Too many tiles ({len(items)}), the limit is {GALLERY_MAX_TILES}")
+    entries = []
+    for number, item in enumerate(items, 1):
+        if isinstance(item, dict) and "file" in item:
+            item = item["file"]
+        if isinstance(item, str):
+            parsed = parse_output_name(item)
+            if parsed is None:
+                raise ValueError(f"Not an avatar file name: {item!r}")
+            entries.append({"file": item, "title": parsed[0].rsplit(".", 1)[0], "key": parsed[1]})
+        elif isinstance(item, dict):
+            try:
+                row = normalize_batch_row(item)
+            except ValueError as exc:
+                raise ValueError(f"tile {number}: {exc}") from exc
+            row["key"] = render_key(row["title"], row["behaviours"], row["role"], row["profile"])
+            entries.append(row)
+        else:
+            raise ValueError("Tiles must be file names or objects")
+    return entries
+
+
+def render_gallery_tile(row: dict) -> bytes:
+    """Pool worker: the preview-sized render of one row."""
+    return create_avatar_image(
+        row["title"], row["behaviours"], row["role"], row["profile"], scale=PREVIEW_SCALE
+    )
+
+
+def cached_tile(entry: dict):
+    """Encoded image for a tile from the caches, or None."""
+    data = render_cache.get(variant_key(entry["key"], IMAGE_ENCODER, PREVIEW_SCALE))
+    if data is None:
+        data = render_cache.get(variant_key(entry["key"], IMAGE_ENCODER))
+    if data is None and "file" in entry:
+        data = result_store.get(entry["file"])
+        if data is None:
+            data, _ = output_storage.read(entry["file"])
+    return data
+
+
+def iter_gallery_tiles(entries, pool, window: int):
+    """
+    Yield (entry, encoded image or None) in order. Cache misses are rendered
+    in the pool, with at most `window` renders in flight.
+    """
+    pending = deque()
+    todo = iter(entries)
+    while True:
+        while len(pending) < window:
+            entry = next(todo, None)
+            if entry is None:
+                break
+            data = cached_tile(entry)
+            metrics.inc("avatar_cache_lookups_total", cache="gallery",
+                        result="hit" if data is not None else "miss")
+            if data is None and "file" not in entry:
+                data = submit_render(pool, render_gallery_tile, entry)
+            pending.append((entry, data))
+        if not pending:
+            return
+        entry, data = pending.popleft()
+        if isinstance(data, Future):
+            try:
+                data = data.result()
+            except Exception as exc:
+                app.logger.exception("Rendering gallery tile %r failed", entry["title"])
+                if isinstance(exc, BrokenProcessPool):
+                    reset_render_pool(pool)
+                data = None
+            else:
+                render_cache.put(variant_key(entry["key"], IMAGE_ENCODER, PREVIEW_SCALE), data)
+        yield entry, data
+
+
+def gallery_tile(entry: dict, data, size) -> Image.Image:
+    """The tile image, or a placeholder naming the avatar that is missing."""
+    if data is not None:
+        try:
+            tile = Image.open(io.BytesIO(data)).convert("RGB")
+        except OSError:  # e.g. an SVG from the result store
+            tile = None
+        if tile is not None:
+            if tile.size != size:
+                tile = tile.resize(size, Image.LANCZOS)
+            return tile
+    tile = Image.new("RGB", size, BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(tile)
+    draw.text((16, 16), entry["title"], font=get_font(18), fill=(34, 46, 80))
+    draw.text((16, 44), "Not available", font=get_font(14), fill=(120, 120, 120))
+    return tile
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def stream_gallery_png(entries, pool, columns: int, window: int = GALLERY_WINDOW):
+    """Yield an RGB PNG of the tiles in `columns` columns, one row of tiles at a time."""
+    tile_w, tile_h = scaled(IMAGE_SIZE, PREVIEW_SCALE)
+    rows = math.ceil(len(entries) / columns)
+    width = columns * tile_w + (columns + 1) * GALLERY_GAP
+    height = rows * (tile_h + GALLERY_GAP) + GALLERY_GAP
+    yield PNG_SIGNATURE + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    compressor = zlib.compressobj(6)
+    stride = width * 3
+
+    def band_chunk(band: Image.Image) -> bytes:
+        raw = band.tobytes()
+        # Filter type 0 (none) in front of every scanline.
+        scanlines = b"".join(b"\x00" + raw[i:i + stride] for i in range(0, len(raw), stride))
+        data = compressor.compress(scanlines)
+        return png_chunk(b"IDAT", data) if data else b""
+
+    band = Image.new("RGB", (width, GALLERY_GAP), GALLERY_BACKGROUND)
+    yield band_chunk(band)
+    tiles = iter_gallery_tiles(entries, pool, window)
+    for _ in range(rows):
+        band = Image.new("RGB", (width, tile_h + GALLERY_GAP), GALLERY_BACKGROUND)
+        for column, (entry, data) in enumerate(itertools.islice(tiles, columns)):
+            x = GALLERY_GAP + column * (tile_w + GALLERY_GAP)
+            band.paste(gallery_tile(entry, data, (tile_w, tile_h)), (x, 0))
+        yield band_chunk(band)
+    yield png_chunk(b"IDAT", compressor.flush()) + png_chunk(b"IEND", b"")
+
+
+# =========================
+# ASYNC JOBS
+# =========================
+
+JOB_QUEUE_SIZE = 32          # queued jobs per worker before /generate answers 429
+JOB_WORKERS = 2
+JOB_TTL_SECONDS = 600        # finished jobs are forgotten after this
+JOB_RETRY_AFTER_SECONDS = 5
+JOB_DB = os.path.join(OUTPUT_FOLDER, "jobs", "jobs.sqlite3")
+JOB_POLL_SECONDS = 0.5       # how often an events stream checks for progress
+# An events stream ends after this long and the browser's EventSource
+# reconnects, so a sync worker is never held for a whole job.
+JOB_EVENTS_SECONDS = 25
+JOB_KEEPALIVE_SECONDS = 10
+
+_job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_job_workers = []
+_job_workers_lock = threading.Lock()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    """
+    Job status in a SQLite table that every worker on the host reads, so any
+    worker can answer /jobs/<id> and its events, whichever one took the POST.
+
+    A job is rendered by the job threads of the worker that accepted it. If
+    that worker exits first, the job is reported as failed.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    def _connect(self):
+        if self._db is not None and self._db_pid == os.getpid():
+            return self._db
+        # A connection must not cross a fork, so each worker opens its own.
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        db = sqlite3.connect(self.db_path, timeout=5.0, isolation_level=None,
+                             check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner INTEGER NOT NULL, "
+                   "status TEXT NOT NULL, done INTEGER NOT NULL, total INTEGER NOT NULL, "
+                   "results TEXT NOT NULL, error TEXT, version INTEGER NOT NULL, "
+                   "finished REAL)")
+        self._db, self._db_pid = db, os.getpid()
+        return db
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def create(self, job_id: str, total: int):
+        self._execute(
+            "INSERT INTO jobs (id, owner, status, done, total, results, version) "
+            "VALUES (?, ?, 'queued', 0, ?, '[]', 0)",
+            (job_id, os.getpid(), total),
+        )
+
+    def update(self, job_id: str, **changes):
+        if "results" in changes:
+            changes["results"] = json.dumps(changes["results"])
+        if changes.get("status") in ("done", "failed"):
+            changes["finished"] = time.time()
+        assignments = "".join(f"{column} = ?, " for column in changes)
+        self._execute(f"UPDATE jobs SET {assignments}version = version + 1 WHERE id = ?",
+                      (*changes.values(), job_id))
+
+    def delete(self, job_id: str):
+        self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def forget_old(self):
+        self._execute("DELETE FROM jobs WHERE finished < ?", (time.time() - JOB_TTL_SECONDS,))
+
+    def get(self, job_id: str):
+        """The public job dict plus its version, or None for an unknown job."""
+        rows = self._execute("SELECT owner, status, done, total, results, error, version "
+                             "FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        owner, status, done, total, results, error, version = rows[0]
+        if status in ("queued", "running") and not _pid_alive(owner):
+            self.update(job_id, status="failed", error="The worker rendering this job exited.")
+            return self.get(job_id)
+        job = {
+            "id": job_id,
+            "status": status,
+            "done": done,
+            "total": total,
+            "results": json.loads(results),
+            "error": error,
+        }
+        return job, version
+
+
+job_store = JobStore(JOB_DB)
+
+
+def _job_worker():
+    while True:
+        job_id, specs = _job_queue.get()
+        try:
+            job_store.update(job_id, status="running")
+            results = []
+            for spec in specs:
+                while True:
+                    try:
+                        result = render_result(spec)
+                        break
+                    except RenderOverloaded:
+                        # Queued work waits for capacity instead of failing.
+                        time.sleep(RENDER_RETRY_AFTER_SECONDS)
+                results.append(
+                    {k: result[k] for k in ("title", "file", "format", "url", "preview_url")}
+                )
+                job_store.update(job_id, done=len(results), results=results)
+            job_store.update(job_id, status="done")
+        except Exception as exc:
+            app.logger.exception("Job %s failed", job_id)
+            job_store.update(job_id, status="failed", error=str(exc) or exc.__class__.__name__)
+        finally:
+            _job_queue.task_done()
+
+
+def _start_job_workers():
+    with _job_workers_lock:
+        while len(_job_workers) < JOB_WORKERS:
+            worker = threading.Thread(target=_job_worker, name="avatar-job", daemon=True)
+            worker.start()
+            _job_workers.append(worker)
+
+
+def submit_job(specs) -> str:
+    """Queue a render job and return its id; queue.Full when this worker's queue is full."""
+    _start_job_workers()
+    job_store.forget_old()
+    job_id = uuid.uuid4().hex
+    job_store.create(job_id, len(specs))
+    try:
+        _job_queue.put_nowait((job_id, specs))
+    except queue.Full:
+        job_store.delete(job_id)
+        raise
+    return job_id
+
+
+def iter_job_events(job_id: str, seen: int = -1):
+    """
+    Server-sent events with the job status, until it is done or failed or
+    JOB_EVENTS_SECONDS have passed. Each event's id is the job version, so a
+    reconnecting EventSource (Last-Event-ID) only gets what it has not seen.
+    """
+    yield f"retry: {int(JOB_POLL_SECONDS * 1000)}\n\n"
+    started = last_sent = time.monotonic()
+    while True:
+        found = job_store.get(job_id)
+        if found is None:
+            return
+        job, version = found
+        now = time.monotonic()
+        if version != seen:
+            seen, last_sent = version, now
+            yield f"id: {version}\ndata: {json.dumps(job)}\n\n"
+            if job["status"] in ("done", "failed"):
+                return
+        elif now - last_sent >= JOB_KEEPALIVE_SECONDS:
+            last_sent = now
+            yield ": keepalive\n\n"
+        if now - started >= JOB_EVENTS_SECONDS:
+            return
+        time.sleep(JOB_POLL_SECONDS)
 
 
 # =========================
 # FLASK ROUTES
 # =========================
 
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unknown"
+    metrics.observe("avatar_request_seconds", elapsed, endpoint=endpoint)
+    metrics.inc("avatar_requests_total", endpoint=endpoint, status=response.status_code)
+
+    if SERVER_TIMING:
+        # Until the response started; the stages of each render are reported
+        # in its result block (see render_report()).
+        response.headers["Server-Timing"] = f"total;dur={elapsed * 1e3:.2f}"
+    return response
+
+
+@app.errorhandler(InputTooLarge)
+def input_too_large(exc):
+    if wants_async():
+        return {"error": str(exc)}, 400
+    return f"{exc} Please shorten the text and try again.", 400
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(exc):
+    metrics.inc("avatar_input_rejections_total", reason="request_size")
+    return (
+        f"The request is too large. Behaviours are limited to {MAX_BEHAVIOUR_LINES} lines "
+        f"of {MAX_LINE_CHARS} characters.",
+        413,
+    )
+
+
+@app.errorhandler(RenderOverloaded)
+def render_overloaded(exc):
+    return (
+        "Too many avatars are being rendered right now. Please try again in a moment.",
+        503,
+        {"Retry-After": str(RENDER_RETRY_AFTER_SECONDS)},
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/storage", methods=["GET"])
+def storage():
+    return output_storage.footprint()
+
+
+@app.route("/fonts", methods=["GET"])
+def fonts():
+    return font_info()
+
+
 @app.route("/", methods=["GET"])
 def index():
-    return render_template_string(html_template)
+    response = Response(INDEX_PAGE, mimetype="text/html")
+    response.set_etag(INDEX_ETAG)
+    return response.make_conditional(request)
+
+
+@app.route("/assets/<name>", methods=["GET"])
+def asset(name):
+    if name != STYLESHEET_NAME:
+        return "File not found", 404
+    return send_image(
+        STYLESHEET.encode("utf-8"),
+        "text/css",
+        name,
+        as_attachment=False,
+        immutable=True,
+        last_modified=STARTED_AT,
+    )
+
+
+def wants_async() -> bool:
+    mode = request.args.get("mode") or request.form.get("mode")
+    return mode == "async"
 
 
 @app.route("/generate", methods=["POST"])
 def generate():
-    output_folder = "avatars_web_output"
-    os.makedirs(output_folder, exist_ok=True)
-
-    result_blocks = []
-
-    # Avatar A
-    title_a = (request.form.get("title_a") or "").strip()
-    role_a = (request.form.get("role_a") or "mentor").strip().lower()
-    profile_a = (request.form.get("profile_a") or "mixed").strip().lower()
-    behaviours_a_text = request.form.get("behaviours_a") or ""
-    behaviours_a = behaviours_a_text.split("\n")
-
-    if title_a or behaviours_a_text.strip():
-        if not title_a:
-            title_a = "Avatar_A"
-        file_a_name = safe_filename(title_a)
-        file_a_path = os.path.join(output_folder, file_a_name)
-        create_avatar_image(title_a, behaviours_a, role_a, profile_a, file_a_path)
-        block = f"""
-        <div class='section'>
-            <h2>{title_a}</h2>
-            <img class="avatar-preview" src="/download/{file_a_name}?inline=1" alt="{title_a}">
-            <br>
-            <a href="/download/{file_a_name}">Download PNG</a>
-        </div>
-        """
-        result_blocks.append(block)
-
-    # Avatar B
-    title_b = (request.form.get("title_b") or "").strip()
-    role_b = (request.form.get("role_b") or "trainee").strip().lower()
-    profile_b = (request.form.get("profile_b") or "mixed").strip().lower()
-    behaviours_b_text = request.form.get("behaviours_b") or ""
-    behaviours_b = behaviours_b_text.split("\n")
-
-    if title_b or behaviours_b_text.strip():
-        if not title_b:
-            title_b = "Avatar_B"
-        file_b_name = safe_filename(title_b)
-        file_b_path = os.path.join(output_folder, file_b_name)
-        create_avatar_image(title_b, behaviours_b, role_b, profile_b, file_b_path)
-        block = f"""
-        <div class='section'>
-            <h2>{title_b}</h2>
-            <img class="avatar-preview" src="/download/{file_b_name}?inline=1" alt="{title_b}">
-            <br>
-            <a href="/download/{file_b_name}">Download PNG</a>
-        </div>
-        """
-        result_blocks.append(block)
+    if request.content_length is not None and request.content_length > MAX_FORM_BYTES:
+        raise RequestEntityTooLarge()
+    specs = []
+    for slot, default_title, default_role in AVATAR_SLOTS:
+        spec = read_avatar_form(request.form, slot, default_title, default_role)
+        if spec is not None:
+            specs.append(spec)
+
+    if not wants_async() and admission.saturated():
+        # Checked up front: once the streamed page has started it is a 200.
+        raise RenderOverloaded()
+
+    if wants_async():
+        if not specs:
+            return {"error": "Enter at least a title or behaviours."}, 400
+        try:
+            job_id = submit_job(specs)
+        except queue.Full:
+            return (
+                {"error": "Too many queued jobs, try again shortly."},
+                429,
+                {"Retry-After": str(JOB_RETRY_AFTER_SECONDS)},
+            )
+        return (
+            {
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                "events_url": f"/jobs/{job_id}/events",
+            },
+            202,
+            {"Location": f"/jobs/{job_id}"},
+        )
 
-    if not result_blocks:
+    if not specs:
         return """
         <h2>No avatars generated</h2>
         <p>Please go back and enter at least a title or behaviours.</p>
         <p><a href="/">Back</a></p>
         """
 
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Generated Avatars – Boliden Mentorship</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; background: #f4f7fa; color: #1f2933; }}
-            .section {{
-                margin-bottom: 20px;
-                padding: 15px 18px;
-                background: #ffffff;
-                border-radius: 10px;
-                border: 1px solid #d0d7e2;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.03);
-            }}
-            .avatar-preview {{
-                max-width: 380px;
-                border-radius: 8px;
-                border: 1px solid #d0d7e2;
-                background: white;
-            }}
-            a {{ color: #3C577C; }}
-            a:hover {{ text-decoration: underline; }}
-        </style>
-    </head>
-    <body>
-        <h1>Generated Avatars</h1>
-        {''.join(result_blocks)}
-        <p><a href="/">Create more avatars</a></p>
-    </body>
-    </html>
-    """
-    return html
+    return Response(
+        stream_with_context(
+            stream_result_page(specs, negotiate_encoder(request.accept_mimetypes))
+        ),
+        mimetype="text/html",
+        # Ask buffering proxies (nginx) to pass each block on as it is flushed.
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    found = job_store.get(job_id)
+    if found is None:
+        return {"error": "Unknown job"}, 404
+    return found[0]
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    found = job_store.get(job_id)
+    if found is None:
+        return {"error": "Unknown job"}, 404
+    job, version = found
+    try:
+        seen = int(request.headers.get("Last-Event-ID", -1))
+    except ValueError:
+        seen = -1
+    if seen == version and job["status"] in ("done", "failed"):
+        # The client has the final state; 204 tells EventSource to stop reconnecting.
+        return "", 204
+    return Response(
+        iter_job_events(job_id, seen),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    """
+    Render many avatars at once. Accepts a JSON list of
+    {title, role, profile, behaviours} objects or a CSV with those columns,
+    either as the request body or as an uploaded "file", and streams back a
+    ZIP of PNGs with a manifest.json.
+    """
+    upload = request.files.get("file")
+    if upload is not None:
+        raw = upload.read()
+        is_json = (upload.filename or "").lower().endswith(".json")
+    else:
+        raw = request.get_data()
+        is_json = request.is_json
+
+    try:
+        text = raw.decode("utf-8-sig")
+        if not is_json and text.lstrip().startswith(("[", "{")):
+            is_json = True
+        rows = parse_batch_rows(text, is_json)
+    except (UnicodeDecodeError, ValueError, csv.Error) as exc:
+        return f"Invalid batch input: {exc}", 400
+
+    pool = get_render_pool()
+    body = stream_batch_zip(rows, pool, window=2 * BATCH_WORKERS)
+    return Response(
+        stream_with_context(body),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=avatars.zip"},
+    )
+
+
+@app.route("/gallery", methods=["GET", "POST"])
+def gallery():
+    """
+    One PNG contact sheet of many avatars. GET takes ?file=<name> once per
+    avatar rendered before; POST takes a JSON list of file names and/or
+    {title, role, profile, behaviours} objects, or {"tiles": [...],
+    "columns": n}. Avatars that were never rendered are rendered first.
+    """
+    columns = request.args.get("columns", type=int)
+    if request.method == "GET":
+        items = request.args.getlist("file")
+    else:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            columns = body.get("columns", columns)
+            body = body.get("tiles")
+        items = body
+    try:
+        entries = parse_gallery_entries(items)
+    except ValueError as exc:
+        return f"Invalid gallery input: {exc}", 400
+
+    if not isinstance(columns, int) or columns < 1:
+        columns = math.ceil(math.sqrt(len(entries)))
+    columns = min(columns, GALLERY_MAX_COLUMNS, len(entries))
+    pool = get_render_pool() if any("file" not in e for e in entries) else None
+    return Response(
+        stream_with_context(stream_gallery_png(entries, pool, columns)),
+        mimetype="image/png",
+        headers={"Content-Disposition": "inline; filename=gallery.png"},
+    )
 
 
 @app.route("/download/<filename>", methods=["GET"])
 def download(filename):
-    filepath = os.path.join("avatars_web_output", filename)
-    if not os.path.exists(filepath):
+    inline = request.args.get("inline")
+    parsed = parse_output_name(filename)
+    download_name = parsed[0] if parsed else filename
+    last_modified = STARTED_AT
+
+    # ?size=preview serves the small render made alongside the full one;
+    # once it has been evicted the full-size image stands in for it, but
+    # only until the preview is back, so that response is not immutable.
+    ext = parsed[2] if parsed else "png"
+    encoder = OUTPUT_FORMATS.get(ext, IMAGE_ENCODER)
+    scale = 1.0
+    data = None
+    stand_in = False
+    if inline and parsed and ext == "png" and request.args.get("size") == "preview":
+        data = render_cache.get(variant_key(parsed[1], IMAGE_ENCODER, PREVIEW_SCALE))
+        if data is not None:
+            scale = PREVIEW_SCALE
+        else:
+            stand_in = True
+    if data is None:
+        data = result_store.get(filename)
+    if data is None and parsed:
+        # Rendered by another worker: its render cache disk tier is shared.
+        data = render_cache.get(variant_key(parsed[1], encoder))
+    if data is None:
+        data, last_modified = output_storage.read(filename)
+    elif PERSIST_OUTPUT:
+        output_storage.touch(filename)
+    if data is None:
         return "File not found", 404
 
-    inline = request.args.get("inline")
-    if inline:
-        return send_file(filepath, mimetype="image/png")
-    else:
-        return send_file(filepath, as_attachment=True)
+    # PNG previews may be swapped for WebP; the download itself stays a PNG.
+    mimetype = ENCODERS[encoder]["mimetype"]
+    negotiable = bool(inline and parsed and ext == "png" and WEBP_ENCODER)
+    if negotiable and accepts_webp(request.accept_mimetypes):
+        data = transcode_cached(parsed[1], data, WEBP_ENCODER, scale)
+        mimetype = ENCODERS[WEBP_ENCODER]["mimetype"]
+
+    response = send_image(
+        data,
+        mimetype,
+        download_name,
+        as_attachment=not inline,
+        immutable=parsed is not None and not stand_in,
+        last_modified=last_modified,
+    )
+    if negotiable:
+        response.vary.add("Accept")
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+"""
+Render avatars offline, without the web server.
+
+    python avatar_cli.py rows.jsonl --out avatars/
+    python avatar_cli.py rows.csv --tar avatars.tar
+    python avatar_cli.py - --tar - < rows.jsonl > avatars.tar
+    python avatar_cli.py rows.jsonl --out avatars/ --format svg --workers 4
+
+Input rows are {title, role, profile, behaviours} objects, one JSON object
+per line (.jsonl) or a CSV with a header row; behaviours may be a list or a
+string with one behaviour per line or separated by "|", as for /batch.
+
+Output files get the same content-addressed names as /generate
+("<title>-<render key>.png"), so a row whose file already exists in --out
+was rendered from identical inputs by the same drawing code and is skipped.
+After a palette or drawing change RENDER_VERSION changes every key and
+everything is rendered again; so does an edit to the trait lexicon. Rows
+repeating an earlier row are skipped too.
+
+Rendering runs in a process pool on all cores (--workers) with a bounded
+number of rows in flight. Progress and throughput go to stderr.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Offline runs should not fill the web server's on-disk render cache; must
+# be set before app is imported here and in the pool workers.
+os.environ.setdefault("AVATAR_RENDER_CACHE_DISK", "0")
+
+import app
+
+
+# =========================
+# INPUT
+# =========================
+
+def read_rows(path: str, input_format: str = None):
+    """Normalized rows from a JSONL or CSV file ("-" reads stdin)."""
+    if input_format is None:
+        input_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    if path == "-":
+        f = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig")
+    else:
+        f = open(path, encoding="utf-8-sig", newline="")
+
+    rows = []
+    with f:
+        if input_format == "csv":
+            reader = csv.DictReader(f)
+            if not reader.fieldnames or "title" not in reader.fieldnames:
+                raise ValueError("CSV input needs a header row with at least a 'title' column")
+            for row_no, row in enumerate(reader, 1):
+                try:
+                    rows.append(app.normalize_batch_row(row))
+                except ValueError as exc:
+                    raise ValueError(f"row {row_no}: {exc}") from exc
+        else:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError(f"line {line_no}: expected a JSON object")
+                try:
+                    rows.append(app.normalize_batch_row(row))
+                except ValueError as exc:
+                    raise ValueError(f"line {line_no}: {exc}") from exc
+    return rows
+
+
+# =========================
+# RENDERING
+# =========================
+
+def render_row(row: dict, encoder: str, path: str = None):
+    """
+    Pool worker: render one row and return its bytes. With a path the file is
+    written (atomically) by the worker itself and only its size is returned,
+    so no image bytes travel back to the parent.
+    """
+    data = app.create_avatar_image(
+        row["title"], row["behaviours"], row["role"], row["profile"], path, encoder
+    )
+    return len(data) if path else data
+
+
+class TarSink:
+    """Streams rendered files into a tar archive (a file or stdout)."""
+
+    def __init__(self, path: str):
+        fileobj = sys.stdout.buffer if path == "-" else open(path, "wb")
+        self._tar = tarfile.open(fileobj=fileobj, mode="w|")
+
+    def add(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self._tar.close()
+
+
+class Progress:
+    """Counts and throughput, printed to stderr at most every `interval` seconds."""
+
+    def __init__(self, total: int, interval: float = 1.0):
+        self.total = total
+        self.interval = interval
+        self.counts = {"rendered": 0, "skipped": 0, "failed": 0}
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self._last_print = 0.0
+
+    def add(self, outcome: str, size: int = 0):
+        self.counts[outcome] += 1
+        self.bytes += size
+        now = time.perf_counter()
+        if now - self._last_print >= self.interval:
+            self._last_print = now
+            self.print()
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        done = sum(self.counts.values())
+        rate = self.counts["rendered"] / elapsed if elapsed else 0.0
+        return (f"[{done}/{self.total}] {rate:.1f} renders/s, "
+                f"{self.counts['rendered']} rendered, {self.counts['skipped']} skipped, "
+                f"{self.counts['failed']} failed, {self.bytes / 1e6:.1f} MB "
+                f"in {elapsed:.1f}s")
+
+    def print(self):
+        print(self.line(), file=sys.stderr, flush=True)
+
+
+def run(rows, args) -> Progress:
+    ext = args.format
+    encoder = app.OUTPUT_FORMATS[ext]
+    sink = TarSink(args.tar) if args.tar else None
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    progress = Progress(len(rows), args.interval)
+    seen = set()
+    pending = {}
+    window = 2 * args.workers
+    todo = iter(rows)
+
+    def submit(pool) -> bool:
+        for row in todo:
+            key = app.render_key(row["title"], row["behaviours"], row["role"], row["profile"])
+            name = app.output_name(row["title"], key, ext)
+            path = os.path.join(args.out, name) if args.out else None
+            if name in seen or (path and not args.force and os.path.exists(path)):
+                progress.add("skipped")
+                continue
+            seen.add(name)
+            pending[pool.submit(render_row, row, encoder, path)] = name
+            return True
+        return False
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        while len(pending) < window and submit(pool):
+            pass
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    print(f"{name}: {exc or exc.__class__.__name__}", file=sys.stderr)
+                    progress.add("failed")
+                    continue
+                if sink is not None:
+                    sink.add(name, result)
+                    result = len(result)
+                progress.add("rendered", result)
+            while len(pending) < window and submit(pool):
+                pass
+
+    if sink is not None:
+        sink.close()
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL or CSV file, or - for stdin")
+    parser.add_argument("--input-format", choices=("jsonl", "csv"),
+                        help="default: csv for *.csv, jsonl otherwise")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--out", metavar="DIR", help="write files into this directory")
+    target.add_argument("--tar", metavar="FILE", help="stream files into a tar (- for stdout)")
+    parser.add_argument("--format", choices=sorted(app.OUTPUT_FORMATS), default="png")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true",
+                        help="render rows even if their file already exists in --out")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between progress lines")
+    args = parser.parse_args()
+
+    try:
+        rows = read_rows(args.input, args.input_format)
+    except (OSError, ValueError, csv.Error) as exc:
+        parser.error(f"cannot read {args.input}: {exc}")
+
+    progress = run(rows, args)
+    progress.print()
+    sys.exit(1 if progress.counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
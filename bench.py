@@ -0,0 +1,591 @@
+"""
+Benchmarks for the avatar generator.
+
+    python bench.py traits            # compiled trait matcher vs. the old scans
+    python bench.py suite             # per-stage latency over realistic corpora
+    python bench.py suite --save base.json
+    python bench.py suite --compare base.json
+    python bench.py encode            # encode time vs. bytes per image encoder
+    python bench.py backends          # raster vs. SVG render latency and size
+    python bench.py pages             # requests/s for the HTML pages
+    python bench.py service           # per-worker renders vs. render_service.py
+
+The suite times each render stage separately (trait analysis, figure
+drawing, text layout, PNG encode, a full uncached render and /generate
+through the Flask test client) for every corpus x role x profile, and
+reports p50/p95/p99 latency, operations per second and peak Python
+allocations. Saved baselines can be compared between runs; the command
+fails when a stage's p50 regresses by more than --threshold percent.
+"""
+
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import PIL
+from PIL import Image, ImageDraw
+
+import app
+
+
+# =========================
+# TRAIT MATCHING
+# =========================
+
+def legacy_trait_scores(text: str) -> dict:
+    """The pre-compiled scoring: one `w in text` scan per keyword."""
+    return {
+        category: sum(w in text for w in words)
+        for category, words in app.lexicon.current().lexicon.items()
+    }
+
+
+FILLER_WORDS = (
+    "the a is and to of with about their often sometimes in meetings "
+    "questions feedback team work goals och att är med i på sina ofta"
+).split()
+
+
+def random_word(rng) -> str:
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyzåäö") for _ in range(rng.randint(3, 10)))
+
+
+def behaviour_corpus(n_lines: int, keyword_share: float, seed: int = 1, open_vocabulary=False):
+    """
+    Random behaviour lines mixing lexicon keywords with filler words, or with
+    made-up words never seen before when open_vocabulary is set.
+    """
+    rng = random.Random(seed)
+    keywords = sorted({w for words in app.lexicon.current().lexicon.values() for w in words})
+    lines = []
+    for _ in range(n_lines):
+        words = [
+            rng.choice(keywords) if rng.random() < keyword_share
+            else random_word(rng) if open_vocabulary else rng.choice(FILLER_WORDS)
+            for _ in range(rng.randint(3, 9))
+        ]
+        lines.append("- " + " ".join(words).capitalize())
+    return lines
+
+
+def time_per_call(fn, arg, min_time=0.2):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn(arg)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def bench_traits(args):
+    matcher = app.lexicon.current()
+    print(f"{'vocabulary':>10} {'lines':>6} {'chars':>8} {'share':>6} "
+          f"{'old us':>10} {'new us':>10} {'speedup':>8}")
+    for vocabulary in ("filler", "open"):
+        for n_lines in (5, 20, 100, 500, 2000):
+            for share in (0.05, 0.3):
+                text = "\n".join(behaviour_corpus(
+                    n_lines, share, open_vocabulary=vocabulary == "open")).lower()
+                if legacy_trait_scores(text) != matcher.scores(text):
+                    raise SystemExit(f"score mismatch for {n_lines} lines, share {share}")
+                old = time_per_call(legacy_trait_scores, text, args.min_time)
+                new = time_per_call(matcher.scores, text, args.min_time)
+                print(f"{vocabulary:>10} {n_lines:>6} {len(text):>8} {share:>6} "
+                      f"{old * 1e6:>10.1f} {new * 1e6:>10.1f} {old / new:>7.1f}x")
+
+
+# =========================
+# STAGE SUITE
+# =========================
+
+ENGLISH_SHORT = [
+    "- Listens deeply",
+    "- Asks open questions",
+    "- Encourages reflection",
+]
+ENGLISH_LONG = [
+    "- Listens deeply and lets the trainee finish their thoughts",
+    "- Asks open questions instead of giving the answer straight away",
+    "- Encourages reflection after every meeting",
+    "- Is honest and transparent about their own mistakes",
+    "- Comes prepared with notes from the last session",
+    "- Warm, caring and welcoming when we meet",
+    "- Energetic and engaged, inspiring the whole team",
+    "- Sometimes a bit tired late on Fridays",
+    "- Supportive when things go wrong and never shames anyone",
+    "- Respects boundaries and keeps what we discuss confidential",
+    "- Follows up on the goals we agreed on",
+    "- Shares contacts and opens doors across the organisation",
+] * 3
+SWEDISH_SHORT = [
+    "- Lyssnar inte",
+    "- Avbryter ofta",
+    "- Pratar om sig själv",
+]
+SWEDISH_LONG = [
+    "- Lyssnar och är närvarande under hela mötet",
+    "- Är nyfiken och ställer öppna frågor",
+    "- Uppmuntrar till reflektion efter varje möte",
+    "- Ärlig och transparent, även om sina egna misstag",
+    "- Kommer förberedd med anteckningar",
+    "- Trygg, snäll och varm i bemötandet",
+    "- Engagerad och inspirerar hela gruppen",
+    "- Ibland trött och nedstämd efter långa veckor",
+    "- Ställer in möten med kort varsel",
+    "- Ingen återkoppling på det vi kom överens om",
+    "- Kan vara stel och kall i större grupper",
+    "- Kritiserar sällan men klandrar ibland andra",
+] * 3
+MIXED = ENGLISH_SHORT + SWEDISH_SHORT + [
+    "- Interrupts others, ibland sarkastisk",
+    "- Always late men alltid engagerad",
+    "- Distant in meetings, trygg one-on-one",
+]
+
+CORPORA = {
+    "en-short": ENGLISH_SHORT,
+    "en-long": ENGLISH_LONG,
+    "sv-short": SWEDISH_SHORT,
+    "sv-long": SWEDISH_LONG,
+    "mixed": MIXED,
+}
+ROLES = ("mentor", "trainee")
+PROFILES = ("ultimate", "worst", "mixed")
+
+
+def suite_cases():
+    for corpus, behaviours in CORPORA.items():
+        for role in ROLES:
+            for profile in PROFILES:
+                yield f"{corpus}/{role}/{profile}", behaviours, role, profile
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(fn, iterations: int) -> dict:
+    """Latency percentiles (ms), throughput and peak Python allocations of fn()."""
+    fn()  # warm-up: imports, fonts, first-call caches
+    tracemalloc.start()
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durations.sort()
+    total = sum(durations)
+    return {
+        "p50_ms": percentile(durations, 50) * 1e3,
+        "p95_ms": percentile(durations, 95) * 1e3,
+        "p99_ms": percentile(durations, 99) * 1e3,
+        "per_sec": len(durations) / total if total else 0.0,
+        "peak_kib": peak / 1024,
+    }
+
+
+def _uncached(fn, layers: bool = False):
+    """
+    Run fn with the render cache and the layout memo out of the way, and
+    the layer cache too unless layers is set.
+    """
+    def run():
+        saved = app.render_cache, app.layer_cache
+        app.render_cache = app.RenderCache(None, 0, 0)
+        if not layers:
+            app.layer_cache = app.LayerCache(app.LAYER_CACHE_MAX_BYTES)
+        app.wrap_lines.cache_clear()
+        try:
+            return fn()
+        finally:
+            app.render_cache, app.layer_cache = saved
+    return run
+
+
+def stage_functions(behaviours, role, profile, client):
+    traits = app.analyze_behaviours(behaviours, role, profile)
+    max_width = app.IMAGE_SIZE[0] - app.TEXT_LEFT - app.TEXT_MARGIN
+    max_height = app.IMAGE_SIZE[1] - app.TEXT_TOP - app.TEXT_MARGIN
+    rendered = app.draw_avatar_image("Bench", behaviours, role, profile)
+    form = {
+        "title_a": "Bench", "role_a": role, "profile_a": profile,
+        "behaviours_a": "\n".join(behaviours),
+    }
+
+    def figure():
+        canvas = Image.new("RGB", app.IMAGE_SIZE, app.BACKGROUND_COLOR)
+        app.draw_avatar_person(ImageDraw.Draw(canvas), app.AVATAR_BOX, traits)
+
+    def layout():
+        app.wrap_lines.cache_clear()
+        app.fit_behaviours(behaviours, max_width, max_height)
+
+    def encode():
+        app.encode_image(rendered, app.IMAGE_ENCODER)
+
+    edits = itertools.count()
+
+    def render_edit():
+        # One changed line: the header and figure layers are reused.
+        edited = list(behaviours) + [f"Edit number {next(edits)}"]
+        app.render_avatar_bytes("Bench", edited, role, profile)
+
+    def generate():
+        response = client.post("/generate", data=form)
+        assert response.status_code == 200, response.status_code
+        response.get_data()  # the page is streamed; rendering happens while it is read
+
+    return {
+        "analyze": lambda: app.compute_traits(app.normalize_behaviours(behaviours), role, profile),
+        "analyze_cached": lambda: app.analyze_behaviours(behaviours, role, profile),
+        "figure": figure,
+        "layout": layout,
+        "encode": encode,
+        "render": _uncached(lambda: app.render_avatar_bytes("Bench", behaviours, role, profile)),
+        "render_preview": _uncached(lambda: app.render_avatar_bytes(
+            "Bench", behaviours, role, profile, scale=app.PREVIEW_SCALE)),
+        "render_edit": _uncached(render_edit, layers=True),
+        "generate": _uncached(generate),
+        "generate_cached": generate,
+    }
+
+
+def run_suite(iterations: int, case_filter: str = None) -> dict:
+    client = app.app.test_client()
+    results = {}
+    for name, behaviours, role, profile in suite_cases():
+        if case_filter and case_filter not in name:
+            continue
+        stages = stage_functions(behaviours, role, profile, client)
+        results[name] = {stage: measure(fn, iterations) for stage, fn in stages.items()}
+    return results
+
+
+def summarize(results: dict) -> dict:
+    """Per stage: the median over cases of each metric."""
+    summary = {}
+    stages = next(iter(results.values())).keys() if results else ()
+    for stage in stages:
+        summary[stage] = {
+            metric: statistics.median(case[stage][metric] for case in results.values())
+            for metric in ("p50_ms", "p95_ms", "p99_ms", "per_sec", "peak_kib")
+        }
+    return summary
+
+
+def print_summary(summary: dict, baseline: dict = None):
+    header = f"{'stage':<16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'peak KiB':>9}"
+    if baseline:
+        header += f" {'p50 vs base':>12}"
+    print(header)
+    for stage, m in summary.items():
+        row = (f"{stage:<16} {m['p50_ms']:>9.3f} {m['p95_ms']:>9.3f} {m['p99_ms']:>9.3f} "
+               f"{m['per_sec']:>9.1f} {m['peak_kib']:>9.1f}")
+        base = (baseline or {}).get(stage)
+        if base and base["p50_ms"]:
+            row += f" {(m['p50_ms'] / base['p50_ms'] - 1) * 100:>+11.1f}%"
+        print(row)
+
+
+def bench_suite(args):
+    results = run_suite(args.iterations, args.cases)
+    if not results:
+        raise SystemExit(f"no cases match {args.cases!r}")
+    summary = summarize(results)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["summary"]
+    print(f"{len(results)} cases x {args.iterations} iterations (medians over cases)")
+    print_summary(summary, baseline)
+    print(f"process max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+    regressions = []
+    if baseline:
+        for stage, m in summary.items():
+            base = baseline.get(stage)
+            if base and base["p50_ms"] and m["p50_ms"] > base["p50_ms"] * (1 + args.threshold / 100):
+                regressions.append(stage)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pillow": PIL.__version__,
+                "iterations": args.iterations,
+                "summary": summary,
+                "cases": results,
+            }, f, indent=2)
+        print(f"saved {args.save}")
+
+    if regressions:
+        raise SystemExit(f"p50 regressed more than {args.threshold}% in: {', '.join(regressions)}")
+
+
+# =========================
+# ENCODERS
+# =========================
+
+def bench_encode(args):
+    images = [
+        app.draw_avatar_image("Bench", behaviours, role, profile)
+        for _, behaviours, role, profile in suite_cases()
+    ][::args.every]
+    print(f"{len(images)} renders of {app.IMAGE_SIZE[0]}x{app.IMAGE_SIZE[1]}, "
+          f"default {app.IMAGE_ENCODER!r}, WebP {app.WEBP_ENCODER or 'off'!r}")
+    print(f"{'encoder':<15} {'p50 ms':>9} {'p95 ms':>9} {'mean KiB':>9} {'vs png':>8}")
+    sizes = {}
+    for encoder in app.ENCODERS:
+        if encoder == "webp" and not app.features.check("webp"):
+            continue
+        if "backend" in app.ENCODERS[encoder]:
+            continue  # not an encoding of a raster image
+        timings = []
+        for img in images:
+            timings.append(measure(lambda: app.encode_image(img, encoder), args.iterations))
+        sizes[encoder] = statistics.mean(len(app.encode_image(img, encoder)) for img in images)
+        p50 = statistics.median(t["p50_ms"] for t in timings)
+        p95 = statistics.median(t["p95_ms"] for t in timings)
+        ratio = sizes[encoder] / sizes["png"]
+        print(f"{encoder:<15} {p50:>9.2f} {p95:>9.2f} {sizes[encoder] / 1024:>9.1f} {ratio:>7.0%}")
+
+
+def bench_backends(args):
+    cases = [case for case in suite_cases() if not args.cases or args.cases in case[0]]
+    backends = {"raster": app.IMAGE_ENCODER, "svg": "svg"}
+    print(f"{len(cases)} cases x {args.iterations} iterations, uncached renders "
+          f"(raster encoder {app.IMAGE_ENCODER!r})")
+    print(f"{'case':<26} " + " ".join(
+        f"{name + ' ms':>10} {name + ' KiB':>10}" for name in backends))
+    totals = {name: {"ms": [], "bytes": []} for name in backends}
+    for name, behaviours, role, profile in cases:
+        row = []
+        for backend, encoder in backends.items():
+            def render():
+                return app.render_avatar_bytes("Bench", behaviours, role, profile, encoder)
+            timing = measure(_uncached(render), args.iterations)
+            size = len(render())
+            totals[backend]["ms"].append(timing["p50_ms"])
+            totals[backend]["bytes"].append(size)
+            row.append(f"{timing['p50_ms']:>10.2f} {size / 1024:>10.1f}")
+        print(f"{name:<26} " + " ".join(row))
+    print(f"{'median':<26} " + " ".join(
+        f"{statistics.median(t['ms']):>10.2f} {statistics.median(t['bytes']) / 1024:>10.1f}"
+        for t in totals.values()))
+
+
+# =========================
+# PAGES
+# =========================
+
+def requests_per_second(fn, seconds: float) -> float:
+    fn()  # warm-up
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        fn()
+        done += 1
+    return done / (time.perf_counter() - start)
+
+
+def bench_pages(args):
+    """
+    Requests/s through the Flask test client for the page-building work
+    alone: /generate posts identical forms, so the avatars come from the
+    render cache, and previews are linked rather than inlined.
+    """
+    app.INLINE_PREVIEWS = False
+    client = app.app.test_client()
+    form = {
+        "title_a": "Bench <A> & co", "role_a": "mentor", "profile_a": "ultimate",
+        "behaviours_a": "\n".join(ENGLISH_SHORT),
+        "title_b": "Bench B", "role_b": "trainee", "profile_b": "worst",
+        "behaviours_b": "\n".join(SWEDISH_SHORT),
+    }
+
+    def request(method, path, **kwargs):
+        def run():
+            response = client.open(path, method=method, **kwargs)
+            assert response.status_code == 200, response.status_code
+            return len(response.get_data())
+        return run
+
+    pages = {"index": request("GET", "/"), "generate": request("POST", "/generate", data=form)}
+    stylesheet = getattr(app, "STYLESHEET_URL", None)
+    if stylesheet:
+        pages["stylesheet"] = request("GET", stylesheet)
+    print(f"{'page':<12} {'req/s':>10} {'KiB':>8}")
+    for name, fn in pages.items():
+        rate = requests_per_second(fn, args.seconds)
+        print(f"{name:<12} {rate:>10.0f} {fn() / 1024:>8.1f}")
+
+
+# =========================
+# RENDER SERVICE
+# =========================
+
+def memory_kib(pid: int) -> dict:
+    """RSS and PSS of a process; PSS splits shared pages between their sharers."""
+    usage = {"rss": 0, "pss": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    usage[name.lower()] = int(value.split()[0])
+    except OSError:
+        pass
+    return usage
+
+
+def child_pids(pid: int):
+    pids = []
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    return pids
+
+
+def _web_worker(task):
+    """Pool worker standing in for one gunicorn worker: uncached renders."""
+    prefix, index, renders, steady = task
+    if steady:
+        # A long-running worker ends up with a full sprite cache.
+        app.warm_figure_sprites()
+    app.create_avatar_image(f"{prefix} warm-up {index}", ENGLISH_SHORT, "mentor", "mixed")
+    start = time.time()
+    for i in range(renders):
+        app.create_avatar_image(f"{prefix} {index}-{i}", ENGLISH_SHORT,
+                                ROLES[i % len(ROLES)], PROFILES[i % len(PROFILES)])
+    return start, time.time(), os.getpid()
+
+
+def run_web_workers(prefix: str, clients: int, renders: int, steady: bool = False):
+    """(renders/s, memory of each process) for `clients` processes rendering concurrently."""
+    with multiprocessing.get_context("spawn").Pool(clients) as pool:
+        tasks = [(prefix, i, renders, steady) for i in range(clients)]
+        results = pool.map(_web_worker, tasks)
+        start = min(r[0] for r in results)
+        end = max(r[1] for r in results)
+        pids = sorted({r[2] for r in results})
+        usage = [memory_kib(pid) for pid in pids]
+    return clients * renders / (end - start), usage
+
+
+def bench_service(args):
+    # Titles unique to this run make every render miss, in both models. The
+    # disk cache (and with it the cross-worker render lock) stays on, as in
+    # a deployment.
+    run_id = f"{time.time():.0f}"
+    print(f"{args.clients} web workers x {args.renders} uncached renders, "
+          f"{args.renderers} renderer processes, {os.cpu_count()} CPUs")
+
+    rows = {}
+    rate, usage = run_web_workers(f"Local {run_id}", args.clients, args.renders, args.steady)
+    rows["per-worker"] = (rate, usage, [])
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "render.sock")
+    service = subprocess.Popen(
+        [sys.executable, "render_service.py", "--socket", socket_path,
+         "--workers", str(args.renderers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 120
+        while not os.path.exists(socket_path):
+            if service.poll() is not None or time.time() > deadline:
+                raise SystemExit("render_service.py did not start")
+            time.sleep(0.2)
+        os.environ["AVATAR_RENDER_SERVICE"] = socket_path
+        rate, usage = run_web_workers(f"Service {run_id}", args.clients, args.renders)
+        service_usage = [memory_kib(pid) for pid in [service.pid] + child_pids(service.pid)]
+        rows["service"] = (rate, usage, service_usage)
+    finally:
+        os.environ.pop("AVATAR_RENDER_SERVICE", None)
+        service.terminate()
+        service.wait()
+
+    print(f"{'model':<12} {'renders/s':>10} {'web RSS MiB':>12} {'web PSS MiB':>12} "
+          f"{'svc RSS MiB':>12} {'svc PSS MiB':>12} {'total PSS':>10}")
+    for name, (rate, web, svc) in rows.items():
+        web_rss, web_pss = (sum(u[k] for u in web) / 1024 for k in ("rss", "pss"))
+        svc_rss, svc_pss = (sum(u[k] for u in svc) / 1024 for k in ("rss", "pss"))
+        print(f"{name:<12} {rate:>10.1f} {web_rss:>12.1f} {web_pss:>12.1f} "
+              f"{svc_rss:>12.1f} {svc_pss:>12.1f} {web_pss + svc_pss:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds to spend timing each case")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("traits", help="trait keyword matching").set_defaults(func=bench_traits)
+
+    suite = sub.add_parser("suite", help="per-stage render benchmarks")
+    suite.add_argument("--iterations", type=int, default=30)
+    suite.add_argument("--cases", help="only run cases whose name contains this")
+    suite.add_argument("--save", metavar="JSON", help="write results as a baseline")
+    suite.add_argument("--compare", metavar="JSON", help="compare with a saved baseline")
+    suite.add_argument("--threshold", type=float, default=10.0,
+                       help="allowed p50 regression in percent (default 10)")
+    suite.set_defaults(func=bench_suite)
+
+    encode = sub.add_parser("encode", help="encode time vs. size for each image encoder")
+    encode.add_argument("--iterations", type=int, default=5)
+    encode.add_argument("--every", type=int, default=5,
+                        help="use every Nth suite case as a sample image")
+    encode.set_defaults(func=bench_encode)
+
+    backends = sub.add_parser("backends", help="raster vs. SVG render latency and size")
+    backends.add_argument("--iterations", type=int, default=10)
+    backends.add_argument("--cases", help="only run cases whose name contains this")
+    backends.set_defaults(func=bench_backends)
+
+    pages = sub.add_parser("pages", help="requests/s for the index and result pages")
+    pages.add_argument("--seconds", type=float, default=3.0, help="time spent on each page")
+    pages.set_defaults(func=bench_pages)
+
+    service = sub.add_parser("service", help="per-worker renders vs. render_service.py")
+    service.add_argument("--clients", type=int, default=4, help="web worker processes")
+    service.add_argument("--renderers", type=int, default=2, help="render service processes")
+    service.add_argument("--renders", type=int, default=40, help="renders per web worker")
+    service.add_argument("--steady", action="store_true",
+                         help="let per-worker renderers hold every figure sprite first, "
+                              "as long-running workers do")
+    service.set_defaults(func=bench_service)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
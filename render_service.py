@@ -0,0 +1,176 @@
+"""
+Render service: long-lived renderer processes shared by all web workers.
+
+    python render_service.py --socket /run/avatar/render.sock --workers 4
+    AVATAR_RENDER_SERVICE=/run/avatar/render.sock gunicorn -w 8 app:app
+
+Fonts, figure sprites and the trait lexicon are loaded once, before the
+renderers are forked, so they share those pages instead of each web worker
+holding its own copy; the render and layer caches live in the renderers and
+are reused across web workers. Sprites are pre-rendered up to
+AVATAR_SPRITE_CACHE_BYTES, which can be raised here (~180 MB holds them all)
+since the renderers share them.
+
+Every renderer accepts connections on the same Unix socket and handles one
+render per connection. Requests and replies are JSON, so a client can only
+ask for renders; who may connect at all is up to the socket's permissions
+(put it in a directory only the web workers' user can reach). It writes the
+encoded image into its own shared memory arena and replies with (arena
+name, size); the web worker copies the bytes out and acknowledges, after
+which the arena is reused. Images larger
+than the arena are sent over the socket instead. A renderer that dies is
+replaced; SIGTERM stops the service.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Listener
+
+# The renderers must render themselves rather than forward to a service.
+os.environ.pop("AVATAR_RENDER_SERVICE", None)
+
+import app
+
+ARENA_BYTES = 4 * 1024 * 1024  # per renderer; larger images go over the socket
+MAX_REQUEST_BYTES = 8 * app.MAX_FIELD_BYTES  # behaviours within the limits, JSON-escaped
+
+log = logging.getLogger("render_service")
+
+
+def read_request(conn) -> dict:
+    """The client's render request; ValueError if it is not a valid one."""
+    request = json.loads(conn.recv_bytes(MAX_REQUEST_BYTES))
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+    for field in ("title", "role", "profile", "encoder"):
+        if not isinstance(request.get(field), str):
+            raise ValueError(f"{field!r} must be a string")
+    behaviours = request.get("behaviours")
+    if not isinstance(behaviours, list) or not all(isinstance(b, str) for b in behaviours):
+        raise ValueError("'behaviours' must be a list of strings")
+    if request["encoder"] not in app.ENCODERS:
+        raise ValueError(f"unknown encoder {request['encoder']!r}")
+    scale = request.get("scale")
+    if not isinstance(scale, (int, float)) or not 0 < scale <= 1:
+        raise ValueError("'scale' must be a number in (0, 1]")
+    app.check_input_limits(request["title"], behaviours)
+    return request
+
+
+def send(conn, *reply):
+    conn.send_bytes(json.dumps(reply).encode("utf-8"))
+
+
+def handle(conn, arena: shared_memory.SharedMemory):
+    try:
+        request = read_request(conn)
+    except (ValueError, OSError) as exc:
+        # A malformed request or one over MAX_REQUEST_BYTES (OSError).
+        log.warning("Rejected request: %s", exc)
+        send(conn, "error", str(exc) or exc.__class__.__name__)
+        return
+    try:
+        data = app.create_avatar_image(
+            request["title"], request["behaviours"], request["role"], request["profile"],
+            encoder=request["encoder"], scale=request["scale"],
+        )
+    except Exception as exc:
+        log.exception("Rendering %r failed", request["title"])
+        send(conn, "error", str(exc) or exc.__class__.__name__)
+        return
+    if len(data) <= arena.size:
+        arena.buf[:len(data)] = data
+        send(conn, "shm", arena.name, len(data))
+        conn.recv_bytes(16)  # the client has copied the image out
+    else:
+        send(conn, "bytes", len(data))
+        conn.send_bytes(data)
+
+
+def serve(listener: Listener, arena_bytes: int):
+    """Renderer process: accept and render until told to stop."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the service stops us on Ctrl-C
+    arena = shared_memory.SharedMemory(create=True, size=arena_bytes)
+    try:
+        while True:
+            try:
+                with listener.accept() as conn:
+                    handle(conn, arena)
+            except (OSError, EOFError) as exc:
+                # The web worker went away mid-render; nothing to clean up.
+                log.warning("Connection dropped: %s", exc)
+    finally:
+        arena.close()
+        arena.unlink()  # the service may be restarting this renderer
+
+
+def start_renderer(listener: Listener, arena_bytes: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(listener, arena_bytes)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", required=True, help="path of the Unix socket to listen on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="renderer processes")
+    parser.add_argument("--arena-bytes", type=int, default=ARENA_BYTES,
+                        help="shared memory per renderer")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(message)s")
+
+    # Loaded before forking, so the renderers share these pages.
+    app.lexicon.current()
+    log.info("Pre-rendered %d figure sprites", app.warm_figure_sprites())
+    # One tracker for all renderers, rather than one started by each.
+    resource_tracker.ensure_running()
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)  # left behind by a service that was killed
+    listener = Listener(args.socket, family="AF_UNIX")
+
+    renderers = {start_renderer(listener, args.arena_bytes) for _ in range(args.workers)}
+    log.info("Rendering with %d processes on %s", len(renderers), args.socket)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in renderers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while renderers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        renderers.discard(pid)
+        if not stopping:
+            log.warning("Renderer %d exited (status %d), starting a new one", pid, status)
+            renderers.add(start_renderer(listener, args.arena_bytes))
+
+    listener.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()